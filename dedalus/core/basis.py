@@ -258,13 +258,46 @@ class ImplicitBasis(Basis):
         """Build NCC multiplication matrix."""
         if max_terms is None:
             max_terms = self.coeff_size
-        n_terms = max_term = matrix = 0
-        for p in range(max_terms):
-            if abs(coeffs[p]) >= cutoff:
-                matrix = matrix + coeffs[p]*self.Multiply(p, ncc_basis_meta, arg_basis_meta)
-                n_terms += 1
-                max_term = p
-        return n_terms, max_term, matrix
+        # Select terms above cutoff
+        coeffs = coeffs[:max_terms]
+        terms = np.flatnonzero(np.abs(coeffs) >= cutoff)
+        if terms.size == 0:
+            return 0, 0, 0
+        matrix = self._NCC_matrix(terms, coeffs[terms], ncc_basis_meta, arg_basis_meta)
+        return terms.size, int(terms[-1]), matrix
+
+    def _NCC_matrix(self, terms, coeffs, ncc_basis_meta, arg_basis_meta):
+        """Assemble weighted sum of multiplication matrices in a single pass."""
+        # Join multiplication matrices in COO format
+        coo = [self.Multiply(p, ncc_basis_meta, arg_basis_meta).tocoo() for p in terms]
+        rows = np.concatenate([M.row for M in coo])
+        cols = np.concatenate([M.col for M in coo])
+        data = np.concatenate([c*M.data for c, M in zip(coeffs, coo)])
+        shape = coo[0].shape
+        # Duplicate entries are summed in CSR conversion
+        return sparse.coo_matrix((data, (rows, cols)), shape=shape).tocsr()
+
+    def _Clenshaw_NCC_matrix(self, terms, coeffs):
+        """
+        Weighted sum of polynomial multiplication matrices by Clenshaw
+        recurrence on the Jacobi matrix:
+            sum_p c_p P_p(J)
+            P_(n+1) = (a_n J + b_n) P_n - c_n P_(n-1)
+            B_k = c_k I + (a_k J + b_k) B_(k+1) - c_(k+1) B_(k+2)
+            sum_p c_p P_p(J) = B_0
+        """
+        # Use size 2*N to avoid truncation issues
+        N = self.coeff_size
+        J = self._Jacobi_matrix(2*N)
+        I = sparse.identity(2*N, format='csr')
+        c = np.zeros(terms[-1] + 1, dtype=coeffs.dtype)
+        c[terms] = coeffs
+        B1 = B2 = sparse.csr_matrix((2*N, 2*N))
+        for k in reversed(range(c.size)):
+            a, b, _ = self._recurrence_coefficients(k)
+            _, _, g = self._recurrence_coefficients(k + 1)
+            B1, B2 = c[k]*I + a*(J @ B1) + b*B1 - g*B2, B1
+        return B1[:N, :N].tocsr()
 
 
 class Chebyshev(ImplicitBasis):
@@ -624,6 +657,28 @@ class Chebyshev(ImplicitBasis):
                 Mult[lower, n] += 0.5
         return Mult.tocsr()
 
+    def _NCC_matrix(self, terms, coeffs, ncc_basis_meta, arg_basis_meta):
+        """
+        Toeplitz-plus-Hankel NCC matrix:
+            sum_p c_p T_p * T_n = sum_p c_p (T_(n+p) + T_|n-p|) / 2
+        """
+        size = self.coeff_size
+        # Entries for all (p, n) pairs
+        p = terms[:, None]
+        n = np.arange(size)[None, :]
+        cols = np.broadcast_to(n, (terms.size, size))
+        data = np.broadcast_to(0.5 * coeffs[:, None], (terms.size, size))
+        upper = n + p
+        lower = np.abs(n - p)
+        # Drop entries beyond truncation
+        keep_upper = upper < size
+        keep_lower = lower < size
+        rows = np.concatenate((upper[keep_upper], lower[keep_lower]))
+        cols = np.concatenate((cols[keep_upper], cols[keep_lower]))
+        data = np.concatenate((data[keep_upper], data[keep_lower]))
+        # Duplicate entries are summed in CSR conversion
+        return sparse.coo_matrix((data, (rows, cols)), shape=(size, size)).tocsr()
+
 
 class Legendre(ImplicitBasis):
     """Legendre polynomial basis on the roots grid."""
@@ -929,6 +984,15 @@ class Legendre(ImplicitBasis):
         N = self.coeff_size
         return self._Multiply_ext(n)[:N, :N]
 
+    @staticmethod
+    def _recurrence_coefficients(n):
+        # P[n+1] = (2*n + 1) / (n + 1) * x * P[n] - n / (n + 1) * P[n-1]
+        return (2*n + 1) / (n + 1), 0, n / (n + 1)
+
+    def _NCC_matrix(self, terms, coeffs, ncc_basis_meta, arg_basis_meta):
+        # No meta dependency -- sum by recurrence
+        return self._Clenshaw_NCC_matrix(terms, coeffs)
+
     @CachedMethod
     def _Multiply_ext(self, n):
         # P[n] = (2*n - 1) / n * x * P[n-1] - (n-1) / n * P[n-2]
@@ -1335,12 +1399,33 @@ class Hermite(ImplicitBasis):
             Mpf[p][k,n] = N[k] / N[n] Mpp[p][k,n]
         """
         # Reweight poly-poly matrix
+        return self._reweight_poly_func(self._Multiply_poly_poly(p))
+
+    def _reweight_poly_func(self, matrix):
+        """Convert poly-poly multiplication matrix to poly-func: N[k] / N[n] M[k,n]"""
         n = np.arange(self.coeff_size, dtype=np.longdouble)
         N2 = np.sqrt(np.pi) * 2**n * special.factorial(n, exact=True)
         N = np.sqrt(N2.astype(np.float64))
         Narr = sparse.diags(N)
         Ninv = sparse.diags(1 / N)
-        return Narr @ self._Multiply_poly_poly(p) @ Ninv
+        return Narr @ matrix @ Ninv
+
+    @staticmethod
+    def _recurrence_coefficients(n):
+        # H[n+1] = 2 * x * H[n] - 2 * n * H[n-1]
+        return 2, 0, 2*n
+
+    def _NCC_matrix(self, terms, coeffs, ncc_basis_meta, arg_basis_meta):
+        # Only multiply by polynomials
+        if ncc_basis_meta['envelope']:
+            raise ValueError("Cannot use enveloped functions for NCCs.")
+        # Sum poly-poly matrices by recurrence
+        matrix = self._Clenshaw_NCC_matrix(terms, coeffs)
+        # Dispatch based on arg envelope
+        if arg_basis_meta['envelope']:
+            return self._reweight_poly_func(matrix).tocsr()
+        else:
+            return matrix
 
 
 class Laguerre(ImplicitBasis):
@@ -1750,6 +1835,18 @@ class Laguerre(ImplicitBasis):
             L2 = self._Multiply_poly_poly_ext(n - 2)
             return ((2*n - 1)*J**0 - J) / n * L1 - (n - 1) / n * L2
 
+    @staticmethod
+    def _recurrence_coefficients(n):
+        # L[n+1] = ((2*n + 1) - x) / (n + 1) * L[n] - n / (n + 1) * L[n-1]
+        return -1 / (n + 1), (2*n + 1) / (n + 1), n / (n + 1)
+
+    def _NCC_matrix(self, terms, coeffs, ncc_basis_meta, arg_basis_meta):
+        # Only multiply by polynomials
+        if ncc_basis_meta['envelope']:
+            raise ValueError("Cannot use enveloped functions for NCCs.")
+        # Poly-func matrices match poly-poly matrices, so sum by recurrence
+        return self._Clenshaw_NCC_matrix(terms, coeffs)
+
 
 class Fourier(TransverseBasis):
     """Fourier complex exponential basis."""
@@ -2686,17 +2783,20 @@ class Compound(ImplicitBasis):
         """Build NCC multiplication matrix."""
         if max_terms is None:
             max_terms = self.coeff_size
-        n_terms = max_term = matrix = 0
+        n_terms = max_term = 0
+        blocks = []
         for index, basis in enumerate(self.subbases):
-            n_terms_i = max_term_i = 0
             subcoeffs = self.sub_cdata(coeffs, index, axis=0)
-            for p in range(min(max_terms, subcoeffs.size)):
-                if abs(subcoeffs[p]) >= cutoff:
-                    matrix = matrix + subcoeffs[p]*self.Multiply(index, p, ncc_basis_meta, arg_basis_meta)
-                    n_terms_i += 1
-                    max_term_i = p
+            n_terms_i, max_term_i, block = basis.NCC(ncc_basis_meta, arg_basis_meta, subcoeffs, cutoff, max_terms)
+            if not n_terms_i:
+                block = sparse.csr_matrix((basis.coeff_size, basis.coeff_size), dtype=self.coeff_dtype)
+            blocks.append(block)
             n_terms = max(n_terms, n_terms_i)
             max_term = max(max_term, max_term_i)
+        if not n_terms:
+            return 0, 0, 0
+        # Subbasis NCCs only couple within their own blocks
+        matrix = sparse.block_diag(blocks, format='csr')
         return n_terms, max_term, matrix
 
     @CachedMethod
@@ -0,0 +1,66 @@
+"""
+Fused kernels for combining coefficient data.
+
+"""
+
+cimport cython
+from libc.stdlib cimport malloc, free
+import numpy as np
+
+
+# Create fused type for double precision real and complex
+ctypedef fused double_rc:
+    double
+    double complex
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def linear_combination(double_rc[::1] out, double[::1] coeffs, list arrays):
+    """
+    Compute a linear combination of arrays in a single pass over memory:
+        out = sum(coeffs[j] * arrays[j])
+    Terms are accumulated in order, without allocating temporary arrays.
+
+    Parameters
+    ----------
+    out : 1D array of float64 or complex128
+        Output array
+    coeffs : 1D array of float64
+        Real coefficients for each term
+    arrays : list of 1D arrays of float64 or complex128
+        Input arrays, matching the size and type of the output
+
+    """
+    # Create local copies of loop bounds
+    cdef Py_ssize_t N = out.shape[0]
+    cdef Py_ssize_t J = len(arrays)
+    # Allocate loop variables
+    cdef Py_ssize_t i, j
+    cdef double_rc acc
+    cdef double_rc[::1] view
+    cdef double_rc** ptrs
+    # Check inputs
+    if coeffs.shape[0] != J:
+        raise ValueError("Number of coefficients must match number of arrays.")
+    for j in range(J):
+        if arrays[j].shape[0] != N:
+            raise ValueError("Array sizes must match output size.")
+    if N == 0:
+        return
+    # Collect data pointers
+    ptrs = <double_rc**> malloc(J * sizeof(double_rc*))
+    if not ptrs:
+        raise MemoryError()
+    try:
+        for j in range(J):
+            view = arrays[j]
+            ptrs[j] = &view[0]
+        # Accumulate terms for each element
+        for i in range(N):
+            acc = 0
+            for j in range(J):
+                acc = acc + coeffs[j] * ptrs[j][i]
+            out[i] = acc
+    finally:
+        free(ptrs)
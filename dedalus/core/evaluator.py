@@ -83,11 +83,13 @@ class Evaluator:
         handlers = self.groups[group]
         self.evaluate_handlers(handlers, **kw)
 
-    def evaluate_scheduled(self, wall_time, sim_time, iteration, **kw):
-        """Evaluate all scheduled handlers."""
+    def evaluate_scheduled(self, wall_time, sim_time, iteration, handlers=None, **kw):
+        """Evaluate all scheduled handlers, optionally among a subset of handlers."""
 
+        if handlers is None:
+            handlers = self.handlers
         scheduled_handlers = []
-        for handler in self.handlers:
+        for handler in handlers:
             # Get cadence devisors
             wall_div = wall_time // handler.wall_dt
             sim_div  = sim_time  // handler.sim_dt
@@ -5,19 +5,36 @@ Classes for manipulating pencils.
 
 from functools import partial
 from collections import defaultdict
+import multiprocessing
+import os
+import zipfile
 import numpy as np
+import hashlib
 from scipy import sparse
 from mpi4py import MPI
 import uuid
 
+from .. import __version__
+from .field import Scalar, Array, Field
+from .operators import Separable
 from ..tools.array import zeros_with_pattern
 from ..tools.array import expand_pattern
+from ..tools.cache import CachedFunction
+from ..tools.parsing import evaluate_condition
 from ..tools.progress import log_progress
 from ..tools.sparse import same_dense_block_diag
+from ..tools.sparse import csr_block_diag
+from ..tools.sparse import bandwidths, band_fill, rcm_permutation
+from ..tools.config import config
 
 import logging
 logger = logging.getLogger(__name__.split('.')[-1])
 
+MATRIX_CACHE_DIR = config['matrix construction'].get('MATRIX_CACHE_DIR')
+BUILD_PROCESSES = config['matrix construction'].getint('BUILD_PROCESSES', 1)
+# Increment when the layout of cached matrix files changes
+MATRIX_CACHE_FORMAT = 2
+
 
 def build_pencils(domain):
     """
@@ -49,8 +66,38 @@ def build_pencils(domain):
     return pencils
 
 
-def build_matrices(pencils, problem, matrices):
-    """Build pencil matrices."""
+def build_matrices(pencils, problem, matrices, cache=True, entry_cutoff=None):
+    """
+    Build pencil matrices.
+
+    Parameters
+    ----------
+    pencils : list of pencil objects
+        Local pencils
+    problem : problem object
+        Problem describing the pencil matrices
+    matrices : list of str
+        Names of the pencil matrices to build
+    cache : bool, optional
+        Use the on-disk matrix cache, if enabled in the config (default: True)
+    entry_cutoff : float, optional
+        Cutoff for removing small matrix entries (default: problem.entry_cutoff).
+        Use 0 to keep the full matrices.
+
+    """
+    if entry_cutoff is None:
+        entry_cutoff = problem.entry_cutoff
+    # Load matrices from disk cache if possible
+    cache_path = None
+    if cache and MATRIX_CACHE_DIR.lower() != 'none':
+        cache_path = matrix_cache_path(pencils, problem, matrices, entry_cutoff)
+        if cache_path is not None:
+            loaded = load_matrices(pencils, matrices, cache_path)
+            # Only skip building if all processes loaded, since NCC expansion is collective
+            comm = problem.domain.dist.comm_cart
+            if comm.allreduce(loaded, op=MPI.LAND):
+                logger.info("Loaded pencil matrices from cache.")
+                return
     # Build new cachid for NCC expansions
     cacheid = uuid.uuid4()
     # Build test operator dicts to synchronously expand all NCCs
@@ -61,8 +108,565 @@ def build_matrices(pencils, problem, matrices):
                 test_index = [0] * problem.domain.dim
                 expr.operator_dict(test_index, vars, cacheid=cacheid, **problem.ncc_kw)
     # Build matrices
-    for pencil in log_progress(pencils, logger, 'info', desc='Building pencil matrix', iter=np.inf, frac=0.1, dt=10):
-        pencil.build_matrices(problem, matrices, cacheid=cacheid)
+    if problem.coupled:
+        selection = select_equations(pencils, problem)
+        context = build_context(len(pencils))
+        if context is not None:
+            build_coupled_matrices_pool(context, pencils, problem, matrices, cacheid, entry_cutoff, selection)
+        else:
+            templates = {}
+            for n, pencil in enumerate(log_progress(pencils, logger, 'info', desc='Building pencil matrix', iter=np.inf, frac=0.1, dt=10)):
+                pencil.build_matrices(problem, matrices, cacheid=cacheid, entry_cutoff=entry_cutoff, selection=selection[n], templates=templates)
+    else:
+        build_uncoupled_matrices(pencils, problem, matrices, cacheid=cacheid, entry_cutoff=entry_cutoff)
+    # Save matrices to disk cache
+    if cache_path is not None:
+        save_matrices(pencils, matrices, cache_path)
+
+
+def build_context(n_pencils):
+    """Get the multiprocessing context for building pencil matrices, or None to build serially."""
+    if BUILD_PROCESSES <= 1 or n_pencils <= 1:
+        return None
+    try:
+        return multiprocessing.get_context('fork')
+    except ValueError:
+        logger.warning("Cannot fork processes for building pencil matrices; building serially.")
+        return None
+
+
+# Build arguments inherited by forked build processes
+_build_state = None
+
+
+def build_coupled_matrices_pool(context, pencils, problem, names, cacheid, entry_cutoff, selection):
+    """
+    Build coupled pencil matrices on a pool of BUILD_PROCESSES forked processes.
+
+    The processes inherit the problem and its expanded NCCs, build contiguous
+    batches of pencils, and return the CSR arrays of the pencil matrices.
+    """
+    global _build_state
+    n_batches = min(len(pencils), 4*BUILD_PROCESSES)
+    batches = np.array_split(np.arange(len(pencils)), n_batches)
+    _build_state = (pencils, problem, names, cacheid, entry_cutoff, selection)
+    try:
+        with context.Pool(BUILD_PROCESSES) as pool:
+            results = pool.imap(_build_pencil_batch, batches)
+            for batch in log_progress(batches, logger, 'info', desc='Building pencil matrix batch', iter=np.inf, frac=0.1, dt=10):
+                for n, arrays in zip(batch, next(results)):
+                    for attr, (data, indices, indptr, shape) in arrays.items():
+                        setattr(pencils[n], attr, sparse.csr_matrix((data, indices, indptr), shape=shape))
+    finally:
+        _build_state = None
+
+
+def _build_pencil_batch(batch):
+    """Build a batch of coupled pencils in a forked process, returning their CSR arrays."""
+    pencils, problem, names, cacheid, entry_cutoff, selection = _build_state
+    templates = {}
+    arrays = []
+    for n in batch:
+        pencil = pencils[n]
+        pencil.build_matrices(problem, names, cacheid=cacheid, entry_cutoff=entry_cutoff, selection=selection[n], templates=templates)
+        # Arrays shared between pencils of a batch are only pickled once
+        matrices = {attr: getattr(pencil, attr).tocsr() for attr in matrix_attributes(names)}
+        arrays.append({attr: (A.data, A.indices, A.indptr, A.shape) for attr, A in matrices.items()})
+    return arrays
+
+
+def matrix_attributes(names):
+    """List the pencil attributes set when building the named matrices."""
+    attributes = ['pre_left', 'pre_right', 'LHS']
+    for name in names:
+        attributes.extend([name, name+'_exp'])
+    return attributes
+
+
+def basis_signature(basis):
+    """Describe a basis by the parameters determining its matrices."""
+    signature = [type(basis).__name__]
+    for attr in ['name', 'base_grid_size', 'interval', 'dealias', '_grid_stretch', 'tau_after_pre']:
+        signature.append(getattr(basis, attr, None))
+    if type(basis).__name__ == 'Compound':
+        signature.extend(basis_signature(subbasis) for subbasis in basis.subbases)
+    return tuple(signature)
+
+
+def problem_digest(problem, names, entry_cutoff=None):
+    """
+    Hash the local definition of the named problem matrices.
+
+    Returns None if the matrices depend on data that cannot be hashed.
+    """
+    if entry_cutoff is None:
+        entry_cutoff = problem.entry_cutoff
+    hasher = hashlib.sha1()
+    def update(*items):
+        for item in items:
+            hasher.update(repr(item).encode())
+    domain = problem.domain
+    update(__version__, MATRIX_CACHE_FORMAT)
+    update(type(problem).__name__, list(names), problem.variables, problem.ncc_kw, entry_cutoff)
+    update(np.dtype(domain.grid_dtype).str, [basis_signature(basis) for basis in domain.bases])
+    for var in problem.variables:
+        update(str(problem.meta[var]))
+    for eq in problem.eqs:
+        update(eq['raw_condition'], eq['tau'], eq['constant'])
+        for name in names:
+            expr, vars = eq[name]
+            if expr == 0:
+                update(str(expr), [str(var) for var in vars])
+                continue
+            # Label unnamed data by position, since their default names contain object ids
+            atoms = list(expr.atoms())
+            expr_str = str(expr)
+            for i, atom in enumerate(atoms):
+                if isinstance(atom, (Field, Array)) and not atom.name:
+                    expr_str = expr_str.replace(repr(atom), '<data {}>'.format(i))
+            update(expr_str, [str(var) for var in vars])
+            # Hash the values of all non-variable data (parameters and NCCs)
+            for atom in atoms:
+                if any(atom is var for var in vars):
+                    continue
+                if isinstance(atom, Scalar):
+                    update(atom.value)
+                elif isinstance(atom, Field):
+                    # Hash current data without changing the layout of user fields
+                    update(str(atom.meta), atom.layout.index, atom.scales, atom.data.shape)
+                    hasher.update(np.ascontiguousarray(atom.data).tobytes())
+                elif isinstance(atom, Array):
+                    hasher.update(np.ascontiguousarray(atom.data).tobytes())
+                else:
+                    return None
+    return hasher.hexdigest()
+
+
+def matrix_cache_path(pencils, problem, names, entry_cutoff=None):
+    """Build the path of the matrix cache file for the local pencils, or None if not hashable."""
+    # Combine problem digests from all processes, since NCC data is distributed
+    comm = problem.domain.dist.comm_cart
+    digests = comm.allgather(problem_digest(problem, names, entry_cutoff))
+    if None in digests:
+        logger.debug("Pencil matrices depend on unhashable data; skipping matrix cache.")
+        return None
+    hasher = hashlib.sha1()
+    for digest in digests:
+        hasher.update(digest.encode())
+    hasher.update(np.array([pencil.global_index for pencil in pencils], dtype=int).tobytes())
+    return os.path.join(os.path.expanduser(MATRIX_CACHE_DIR), hasher.hexdigest() + '.npz')
+
+
+def save_matrices(pencils, names, path):
+    """Save CSR pencil matrices to a cache file, concatenated over pencils."""
+    arrays = {}
+    for attr in matrix_attributes(names):
+        matrices = [getattr(pencil, attr).tocsr() for pencil in pencils]
+        arrays[attr+'/shape'] = np.array([matrix.shape for matrix in matrices], dtype=int).reshape(-1, 2)
+        arrays[attr+'/nnz'] = np.array([matrix.nnz for matrix in matrices], dtype=int)
+        for key in ['data', 'indices', 'indptr']:
+            arrays[attr+'/'+key] = np.concatenate([getattr(matrix, key) for matrix in matrices]) if matrices else np.zeros(0)
+    # Write to temporary file and rename to avoid partial reads
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'wb') as file:
+        np.savez(file, **arrays)
+    os.replace(temp_path, path)
+    logger.debug("Saved pencil matrices to cache: {}".format(path))
+
+
+def load_matrices(pencils, names, path):
+    """Load CSR pencil matrices from a cache file, returning False if unavailable."""
+    if not os.path.exists(path):
+        return False
+    try:
+        with np.load(path) as file:
+            for attr in matrix_attributes(names):
+                shapes = file[attr+'/shape']
+                nnzs = file[attr+'/nnz']
+                data = file[attr+'/data']
+                indices = file[attr+'/indices']
+                indptr = file[attr+'/indptr']
+                if len(shapes) != len(pencils):
+                    return False
+                d0 = p0 = 0
+                for pencil, shape, nnz in zip(pencils, shapes, nnzs):
+                    rows = shape[0]
+                    matrix = sparse.csr_matrix((data[d0:d0+nnz], indices[d0:d0+nnz], indptr[p0:p0+rows+1]), shape=tuple(shape))
+                    setattr(pencil, attr, matrix)
+                    d0 += nnz
+                    p0 += rows + 1
+    except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile) as error:
+        # Fall back to rebuilding from truncated or corrupt files
+        logger.warning("Failed to read matrix cache file: {} ({!r})".format(path, error))
+        return False
+    # Share index arrays of expanded matrices with LHS
+    for pencil in pencils:
+        LHS = pencil.LHS
+        for name in names:
+            matrix = getattr(pencil, name+'_exp')
+            if np.array_equal(matrix.indptr, LHS.indptr) and np.array_equal(matrix.indices, LHS.indices):
+                matrix.indices, matrix.indptr = LHS.indices, LHS.indptr
+    return True
+
+
+def build_uncoupled_matrices(pencils, problem, names, cacheid=None, entry_cutoff=None):
+    """
+    Build pencil matrices for uncoupled problems, vectorized over all modes.
+
+    Parameters
+    ----------
+    pencils : list of pencil objects
+        Local pencils
+    problem : problem object
+        Uncoupled problem
+    names : list of str
+        Names of the pencil matrices to build
+    cacheid : optional
+        Cache ID for NCC expansions
+    entry_cutoff : float, optional
+        Cutoff for removing small matrix entries (default: problem.entry_cutoff)
+
+    Notes
+    -----
+    The separable operator symbols (e.g. i*k or -k**2) are evaluated over
+    arrays of the mode indices of all pencils at once, producing dense
+    (nvars, nvars) blocks for every mode.  Each pencil's sparse matrices are
+    then assembled from its blocks.
+
+    """
+    if not pencils:
+        return
+    if entry_cutoff is None:
+        entry_cutoff = problem.entry_cutoff
+    domain = problem.domain
+    zbasis = domain.bases[-1]
+    dtype = zbasis.coeff_dtype
+    Nz = zbasis.coeff_size
+    eqs = problem.eqs
+    nvars = problem.nvars
+    Neqs = len(eqs)
+
+    # Global indices of all modes, ordered by pencil and then last index
+    trans_index = np.array([pencil.global_index for pencil in pencils], dtype=int)
+    trans_index = trans_index.reshape(len(pencils), domain.dim-1)
+    index = [np.repeat(trans_index[:, axis], Nz) for axis in range(domain.dim-1)]
+    index.append(np.tile(np.arange(Nz), len(pencils)))
+    N = len(pencils) * Nz
+    index_dict = {}
+    for axis, basis in enumerate(domain.bases):
+        index_dict['n'+basis.name] = index[axis]
+
+    # Find applicable equations
+    masks = np.array([condition_mask(eq, index_dict, N) for eq in eqs], dtype=bool)
+    masks = masks.reshape(Neqs, N)
+    # Check selections
+    neqs = masks.sum(axis=0)
+    if np.any(neqs != nvars):
+        m = np.flatnonzero(neqs != nvars)[0]
+        mode_index = [int(axis_index[m]) for axis_index in index]
+        raise ValueError("Pencil {} has {} equations for {} variables.".format(mode_index, neqs[m], nvars))
+
+    # Build blocks, placing the selected equations in order within each mode
+    rows = np.cumsum(masks, axis=0) - 1
+    modes = np.arange(N)
+    blocks = {name: np.zeros((N, nvars, nvars), dtype=dtype) for name in names}
+    blocks['select'] = np.zeros((N, nvars, Neqs))
+    for j, eq in enumerate(eqs):
+        selected = masks[j]
+        eq_modes = modes[selected]
+        eq_rows = rows[j, selected]
+        blocks['select'][eq_modes, eq_rows, j] = 1
+        for name in names:
+            expr, vars = eq[name]
+            if expr != 0:
+                op_dict = expr.operator_dict(index, vars, cacheid=cacheid, **problem.ncc_kw)
+                for k in range(nvars):
+                    entries = np.broadcast_to(op_dict[vars[k]], (N,))
+                    blocks[name][eq_modes, eq_rows, k] = entries[selected]
+
+    # Assemble pencil matrices
+    for n, pencil in enumerate(log_progress(pencils, logger, 'info', desc='Building pencil matrix', iter=np.inf, frac=0.1, dt=10)):
+        pencil_blocks = {name: blocks[name][n*Nz:(n+1)*Nz] for name in blocks}
+        pencil._set_uncoupled_matrices(problem, names, pencil_blocks, entry_cutoff)
+
+
+def condition_mask(eq, index_dict, size):
+    """Evaluate an equation condition over arrays of mode indices."""
+    try:
+        mask = np.asarray(evaluate_condition(eq['condition'], index_dict), dtype=bool)
+        if mask.shape in [(), (size,)]:
+            return np.broadcast_to(mask, (size,))
+    except (ValueError, TypeError):
+        # Conditions calling Python builtins (e.g. max) may not act elementwise
+        pass
+    # Fall back to evaluating the raw condition for each mode
+    mask = np.zeros(size, dtype=bool)
+    for m in range(size):
+        mode_dict = {key: value[m] for key, value in index_dict.items()}
+        mask[m] = eval(eq['raw_condition'], mode_dict)
+    return mask
+
+
+def select_equations(pencils, problem):
+    """
+    Evaluate equation conditions over the transverse indices of all pencils.
+
+    Returns
+    -------
+    selection : boolean ndarray
+        Selection of equations (columns) for each pencil (rows)
+
+    """
+    domain = problem.domain
+    global_indices = np.array([pencil.global_index for pencil in pencils], dtype=int)
+    global_indices = global_indices.reshape(len(pencils), domain.dim-1)
+    index_dict = {}
+    for axis, basis in enumerate(domain.bases):
+        if basis.separable:
+            index_dict['n'+basis.name] = global_indices[:, axis]
+    masks = [condition_mask(eq, index_dict, len(pencils)) for eq in problem.eqs]
+    return np.array(masks, dtype=bool).reshape(len(problem.eqs), len(pencils)).T
+
+
+class ParameterPieces:
+    """
+    Pencil matrices built as sums of pieces weighted by scalar parameters.
+
+    The piece matrices are stored on the pencils without removing small
+    entries, so that changing the values of the problem parameters only
+    requires recombining the pieces.  Small entries are removed from the
+    combined matrices, which then match the directly built matrices.  The
+    pieces are rebuilt when any other data they depend on (e.g. NCCs or
+    parameters that do not appear as simple factors) changes.  Matrices
+    without parameter-weighted pieces are built directly.
+
+    Parameters
+    ----------
+    problem : problem object
+        Problem describing the pencil matrices
+    names : list of str
+        Names of the pencil matrices to build from pieces
+
+    """
+
+    def __init__(self, problem, names):
+        self.problem = problem
+        self.names = list(names)
+        self.pieces = {name: problem.split_parameters(name) for name in names}
+        self.piece_names = [piece for name in names for piece, params in self.pieces[name]]
+        self.weighted = any(params for name in names for piece, params in self.pieces[name])
+        self.digests = {}
+
+    def build_matrices(self, pencils):
+        """Build pencil matrices for all local pencils, rebuilding stale pieces."""
+        problem = self.problem
+        if not self.weighted:
+            build_matrices(pencils, problem, self.names)
+            return
+        digest = problem_digest(problem, self.piece_names, 0)
+        stale = (digest is None) or any(self.digests.get(pencil) != digest for pencil in pencils)
+        # Rebuild synchronously since NCC expansion is collective
+        comm = problem.domain.dist.comm_cart
+        if comm.allreduce(stale, op=MPI.LOR):
+            build_matrices(pencils, problem, self.piece_names, entry_cutoff=0)
+            for pencil in pencils:
+                self.digests[pencil] = digest
+        self.combine(pencils)
+
+    def build_pencil_matrices(self, pencil, cacheid=None):
+        """Build pencil matrices for a single pencil, rebuilding stale pieces."""
+        if not self.weighted:
+            pencil.build_matrices(self.problem, self.names, cacheid=cacheid)
+            return
+        digest = problem_digest(self.problem, self.piece_names, 0)
+        if (digest is None) or (self.digests.get(pencil) != digest):
+            pencil.build_matrices(self.problem, self.piece_names, cacheid=cacheid, entry_cutoff=0)
+            self.digests[pencil] = digest
+        self.combine([pencil])
+
+    def combine(self, pencils):
+        """Combine piece matrices weighted by the current parameter values."""
+        problem = self.problem
+        for name in self.names:
+            weights = [(piece, np.prod([param.value for param in params])) for piece, params in self.pieces[name]]
+            for pencil in pencils:
+                # Combine full pieces before removing small entries
+                matrix = None
+                for piece, weight in weights:
+                    term = weight * getattr(pencil, piece)
+                    matrix = term if matrix is None else matrix + term
+                matrix = matrix.tocsr()
+                matrix.eliminate_zeros()
+                matrix = pencil._store_truncated(name, matrix, problem.entry_cutoff)
+                # Store expanded matrix on the shared LHS pattern
+                LHS = pencil.LHS
+                if problem.coupled:
+                    # Expand truncated matrix, as when building directly
+                    if pencil.pre_right is not None:
+                        matrix = matrix @ pencil.pre_right
+                    setattr(pencil, name+'_exp', share_pattern(matrix, LHS))
+                else:
+                    # Uncoupled expanded matrices are not truncated, so combine the piece data
+                    data = np.zeros(LHS.nnz, dtype=np.result_type(LHS.dtype, *[weight for piece, weight in weights]))
+                    for piece, weight in weights:
+                        data += weight * getattr(pencil, piece+'_exp').data
+                    setattr(pencil, name+'_exp', sparse.csr_matrix((data, LHS.indices, LHS.indptr), shape=LHS.shape))
+
+
+def log_bandwidths(pencils, reorder=False, level=logging.DEBUG):
+    """
+    Log the bandwidths and band fill of the pencil LHS matrices.
+
+    Parameters
+    ----------
+    pencils : list of pencil objects
+        Local pencils
+    reorder : bool, optional
+        Also report bandwidths after reverse Cuthill-McKee reordering (default: False)
+    level : int, optional
+        Logging level (default: logging.DEBUG)
+
+    """
+    if not logger.isEnabledFor(level):
+        return
+    # Collect statistics over distinct patterns
+    patterns = {}
+    for pencil in pencils:
+        LHS = pencil.LHS
+        key = (LHS.shape, LHS.indptr.tobytes(), LHS.indices.tobytes())
+        patterns.setdefault(key, LHS)
+    stats = []
+    reordered_stats = []
+    for LHS in patterns.values():
+        stats.append(bandwidths(LHS) + (band_fill(LHS),))
+        if reorder:
+            perm = rcm_permutation(LHS)
+            if perm is not None:
+                LHS = LHS.tocsr()[perm][:, perm]
+            reordered_stats.append(bandwidths(LHS) + (band_fill(LHS),))
+    def report(desc, stats):
+        kl, ku, fill = np.array(stats).T
+        logger.log(level, "{}: max lower {}, max upper {}, min band fill {:.1%}".format(desc, int(kl.max()), int(ku.max()), fill.min()))
+    if stats:
+        report("Pencil LHS bandwidths", stats)
+    if reordered_stats:
+        report("RCM-reordered LHS bandwidths", reordered_stats)
+
+
+def build_block_matrices(pencils, names, share_data=False):
+    """
+    Build block-diagonal matrices joining pencil matrices across all pencils.
+
+    Parameters
+    ----------
+    pencils : list of pencil objects
+        Local pencils, in system data order
+    names : list of str
+        Names of the pencil matrices to join
+    share_data : bool, optional
+        Replace the pencil matrices with CSR matrices whose data arrays are
+        views into the block matrices, so the matrix entries are only held
+        once in memory.  Modifying the entries of either then modifies both.
+        (default: False)
+
+    Returns
+    -------
+    blocks : dict
+        Block-diagonal CSR matrices acting on flattened system data
+
+    Notes
+    -----
+    The pencils from build_pencils are ordered to match the C-ordered
+    transverse axes of the system buffers, so the block matrices act directly
+    on the raveled system data.
+
+    """
+    blocks = {}
+    for name in names:
+        matrices = [sparse.csr_matrix(getattr(pencil, name)) for pencil in pencils]
+        blocks[name] = block = csr_block_diag(matrices)
+        # Block data concatenates the pencil data, unless promoted to a joint dtype
+        if share_data and all(matrix.dtype == block.dtype for matrix in matrices):
+            offsets = np.cumsum([0] + [matrix.nnz for matrix in matrices])
+            for n, (pencil, matrix) in enumerate(zip(pencils, matrices)):
+                data = block.data[offsets[n]:offsets[n+1]]
+                setattr(pencil, name, sparse.csr_matrix((data, matrix.indices, matrix.indptr), shape=matrix.shape))
+    return blocks
+
+
+def group_pencils(pencils, pattern='LHS', contents=()):
+    """
+    Group pencils by the sparsity pattern of a pencil matrix, identifying
+    duplicate pencils within each group by hashing their matrix contents.
+
+    Parameters
+    ----------
+    pencils : list of pencil objects
+        Local pencils
+    pattern : str, optional
+        Name of the pencil matrix setting the group pattern (default: 'LHS')
+    contents : list of str, optional
+        Names of pencil matrices whose data identify duplicate pencils
+        (default: (), no deduplication)
+
+    Returns
+    -------
+    groups : list of PencilGroup objects
+
+    """
+    groups = {}
+    for index, pencil in enumerate(pencils):
+        matrix = getattr(pencil, pattern)
+        pattern_key = hashlib.sha1()
+        pattern_key.update(np.array(matrix.shape).tobytes())
+        pattern_key.update(matrix.indptr.tobytes())
+        pattern_key.update(matrix.indices.tobytes())
+        if contents:
+            content_key = hashlib.sha1()
+            for name in contents:
+                content_key.update(getattr(pencil, name).data.tobytes())
+            content_key = content_key.digest()
+        else:
+            content_key = index
+        duplicates = groups.setdefault(pattern_key.digest(), {})
+        duplicates.setdefault(content_key, []).append(index)
+    return [PencilGroup(list(duplicates.values())) for duplicates in groups.values()]
+
+
+class PencilGroup:
+    """
+    Set of pencils sharing a matrix sparsity pattern.
+
+    Parameters
+    ----------
+    duplicates : list of lists of ints
+        Pencil indices, grouped into lists of pencils with identical matrices
+
+    Attributes
+    ----------
+    unique : int array
+        Indices of representative pencils, by decreasing multiplicity
+    layers : list of int arrays
+        Indices of all pencils, split into layers whose n-th entry is a
+        duplicate of the n-th unique pencil
+
+    Notes
+    -----
+    Ordering the unique pencils by multiplicity makes each layer correspond
+    to a leading subset of the unique pencils, so every layer can be solved
+    with a single batched solve using the factorizations of the unique
+    pencils.
+
+    """
+
+    def __init__(self, duplicates):
+        duplicates = sorted(duplicates, key=len, reverse=True)
+        self.unique = np.array([dup[0] for dup in duplicates], dtype=int)
+        self.layers = []
+        for n in range(len(duplicates[0])):
+            layer = [dup[n] for dup in duplicates if len(dup) > n]
+            self.layers.append(np.array(layer, dtype=int))
 
 
 class Pencil:
@@ -85,22 +689,19 @@ class Pencil:
         else:
             self.build_matrices = self._build_uncoupled_matrices
 
-    def _build_uncoupled_matrices(self, problem, names, cacheid=None):
+    def _build_uncoupled_matrices(self, problem, names, cacheid=None, entry_cutoff=None):
+        build_uncoupled_matrices([self], problem, names, cacheid=cacheid, entry_cutoff=entry_cutoff)
+
+    def _set_uncoupled_matrices(self, problem, names, blocks, entry_cutoff):
+        """Assemble uncoupled pencil matrices from dense blocks for each last index."""
 
-        matrices = {name: [] for name in (names+['select'])}
         zbasis = self.domain.bases[-1]
         dtype = zbasis.coeff_dtype
 
-        # Build submatrices
-        for last_index in range(zbasis.coeff_size):
-            submatrices = self._build_uncoupled_submatrices(problem, names, last_index, cacheid=cacheid)
-            for name in matrices:
-                matrices[name].append(submatrices[name])
-
         # Build block matrices
-        for name in matrices:
-            blocks = matrices[name]
-            matrix = same_dense_block_diag(blocks, format='csr', dtype=dtype)
+        matrices = {}
+        for name in blocks:
+            matrix = same_dense_block_diag(blocks[name], format='csr', dtype=dtype)
             matrix.eliminate_zeros()
             matrices[name] = matrix
 
@@ -113,55 +714,18 @@ class Pencil:
         for name in names:
             # Act on non-right-preconditioned vectors
             matrix = matrices[name] @ self.pre_right.T
-            # Store full matrix
-            matrix.eliminate_zeros()
-            setattr(self, name+'_full', matrix.tocsr().copy())
-            # Store truncated matrix
-            matrix.data[np.abs(matrix.data) < problem.entry_cutoff] = 0
             matrix.eliminate_zeros()
-            setattr(self, name, matrix.tocsr().copy())
+            self._store_truncated(name, matrix, entry_cutoff)
 
         # Store expanded CSR matrices for fast combination
         self.LHS = zeros_with_pattern(*[matrices[name] for name in names]).tocsr()
         for name in names:
-            matrix = matrices[name]
-            matrix = expand_pattern(matrix, self.LHS)
-            setattr(self, name+'_exp', matrix.tocsr().copy())
-
-    def _build_uncoupled_submatrices(self, problem, names, last_index, cacheid=None):
-
-        index = list(self.global_index) + [last_index]
-        index_dict = {}
-        for axis, basis in enumerate(self.domain.bases):
-            index_dict['n'+basis.name] = index[axis]
-
-        # Find applicable equations
-        selected_eqs = [eq for eq in problem.eqs if eval(eq['raw_condition'], index_dict)]
-        # Check selections
-        nvars = problem.nvars
-        neqs = len(selected_eqs)
-        Neqs = len(problem.eqs)
-        if neqs != nvars:
-            raise ValueError("Pencil {} has {} equations for {} variables.".format(index, neqs, nvars))
-
-        # Build matrices
-        dtype = self.domain.bases[-1].coeff_dtype
-        matrices = {name: np.zeros((nvars, nvars), dtype=dtype) for name in names}
-        matrices['select'] = np.zeros((nvars, Neqs))
-        for i, eq in enumerate(selected_eqs):
-            j = problem.eqs.index(eq)
-            matrices['select'][i,j] = 1
-            for name in names:
-                expr, vars = eq[name]
-                if expr != 0:
-                    op_dict = expr.operator_dict(index, vars, cacheid=cacheid, **problem.ncc_kw)
-                    matrix = matrices[name]
-                    for j in range(nvars):
-                        matrix[i,j] = op_dict[vars[j]]
+            setattr(self, name+'_exp', share_pattern(matrices[name], self.LHS))
 
-        return matrices
+    def _build_coupled_matrices(self, problem, names, cacheid=None, entry_cutoff=None, selection=None, templates=None):
 
-    def _build_coupled_matrices(self, problem, names, cacheid=None):
+        if entry_cutoff is None:
+            entry_cutoff = problem.entry_cutoff
 
         zbasis = self.domain.bases[-1]
         zname = zbasis.name
@@ -171,11 +735,9 @@ class Pencil:
 
         # Find applicable equations
         global_index = self.global_index
-        index_dict = {}
-        for axis, basis in enumerate(self.domain.bases):
-            if basis.separable:
-                index_dict['n'+basis.name] = global_index[axis]
-        pencil_eqs = [eq for eq in problem.eqs if eval(eq['raw_condition'], index_dict)]
+        if selection is None:
+            selection = select_equations([self], problem)[0]
+        pencil_eqs = [eq for eq, selected in zip(problem.eqs, selection) if selected]
 
         # Check basic solvability conditions
         n_vars = problem.nvars
@@ -190,9 +752,21 @@ class Pencil:
         if n_const_eqs != n_const_vars + n_tau:
             raise ValueError("Pencil {} has {} constant equations for {} constant variables plus {} differential equations / tau terms.".format(global_index, n_const_eqs, n_const_vars, n_tau))
 
+        # Fill shared template for pencils with the same equation selection
+        varying_blocks = {}
+        if templates is not None:
+            template_key = (np.asarray(selection, dtype=bool).tobytes(), tuple(names))
+            candidates = templates.get(template_key, [])
+            if candidates:
+                # Templates with the same selection share their varying equations,
+                # so build their blocks once and compare them to each template
+                for eq, PL, bi in candidates[0].varying_eqs:
+                    varying_blocks[bi] = self._build_equation_blocks(problem, names, eq, PL, cacheid=cacheid)
+                for template in candidates:
+                    if template.apply(self, varying_blocks, entry_cutoff):
+                        return
+
         # Local references
-        Zero_Nz = sparse.csr_matrix((zsize, zsize), dtype=zdtype)
-        Identity_1 = sparse.identity(1, dtype=zdtype, format='csr')
         Identity_Nz = sparse.identity(zsize, dtype=zdtype, format='csr')
         Drop_Nz = sparse.eye(0, zsize, dtype=zdtype, format='csr')
 
@@ -210,6 +784,7 @@ class Pencil:
         # Build matrices
         LHS_blocks = {name: [] for name in names}
         pre_left_diags = []
+        varying_eqs = []
 
         # Start with match terms
         if compound:
@@ -237,63 +812,39 @@ class Pencil:
                 continue
 
             # Build left preconditioner block
-            if eq['LHS'].meta[zbasis.name]['constant']:
-                PL = zbasis.DropNonfirst
-            elif eq['tau'] and eq['differential']:
-                PL = zbasis.PreconditionDropTau(eq['tau'])
-            elif eq['tau']:
-                PL = zbasis.DropTau(eq['tau'])
-            elif eq['differential']:
-                PL = zbasis.PreconditionDropMatch
-            else:
-                PL = zbasis.DropMatch
+            PL = left_preconditioner(zbasis, eq)
             pre_left_diags.append(PL)
 
             # Build left-preconditioned LHS matrix blocks
-            PL_Zero = sparse.csr_matrix(PL.shape, dtype=zdtype)
-            PL_Zero_coo = sparse.coo_matrix(PL.shape, dtype=zdtype)
-            PL_coo = PL.tocoo()
+            bi = len(LHS_blocks[names[0]])
+            if any(depends_on_pencil(eq[name][0]) for name in names):
+                varying_eqs.append((eq, PL, bi))
+            eq_blocks = varying_blocks.get(bi)
+            if eq_blocks is None:
+                eq_blocks = self._build_equation_blocks(problem, names, eq, PL, cacheid=cacheid)
             for name in names:
-                eq_expr, eq_vars = eq[name]
-                if eq_expr != 0:
-                    Ei = eq_expr.operator_dict(global_index, eq_vars, cacheid=cacheid, **problem.ncc_kw)
-                else:
-                    Ei = defaultdict(int)
-                eq_blocks = []
-                for j in range(n_vars):
-                    # Build equation terms
-                    Eij = Ei[eq_vars[j]]
-                    if np.isscalar(Eij):
-                        if Eij == 0:
-                            Eij = PL_Zero_coo
-                        elif Eij == 1:
-                            Eij = PL_coo
-                        else:
-                            Eij = PL_coo * Eij
-                    elif PL is Identity_Nz:
-                        Eij = Eij.tocoo()
-                    else:
-                        Eij = (PL @ Eij).tocoo()
-                    eq_blocks.append(Eij)
-                LHS_blocks[name].append(eq_blocks)
+                LHS_blocks[name].append(eq_blocks[name])
 
         # Combine blocks
         left_perm = left_permutation(zbasis, n_vars, pencil_eqs)
         right_perm = right_permutation(zbasis, problem)
-        self.pre_left = left_perm @ sparse.block_diag(pre_left_diags, format='csr', dtype=zdtype)
-        self.pre_right = sparse.block_diag(pre_right_diags, format='csr', dtype=zdtype) @ right_perm
-        LHS_matrices = {name: left_perm @ fast_bmat(LHS_blocks[name]).tocsr() for name in names}
+        self.pre_left = sparse.block_diag(pre_left_diags, format='csr', dtype=zdtype)[left_perm]
+        self.pre_right = permute_columns(sparse.block_diag(pre_right_diags, format='coo', dtype=zdtype), right_perm)
+
+        # Build template and fill it to give all its pencils the same patterns
+        if templates is not None:
+            template = CoupledTemplate(problem, names, LHS_blocks, varying_eqs, left_perm, self.pre_left, self.pre_right)
+            if template.valid:
+                template.fill_source(self, entry_cutoff)
+                templates.setdefault(template_key, []).append(template)
+                return
+
+        LHS_matrices = {name: fast_bmat(LHS_blocks[name]).tocsr()[left_perm] for name in names}
 
         # Store minimal-entry matrices for fast dot products
         for name, matrix in LHS_matrices.items():
-            # Store full matrix
-            matrix.eliminate_zeros()
-            setattr(self, name+'_full', matrix.tocsr().copy())
-            # Truncate entries
-            matrix.data[np.abs(matrix.data) < problem.entry_cutoff] = 0
             matrix.eliminate_zeros()
-            # Store truncated matrix
-            setattr(self, name, matrix.tocsr().copy())
+            LHS_matrices[name] = self._store_truncated(name, matrix, entry_cutoff)
 
         # Store expanded right-preconditioned matrices
         # Apply right preconditioning
@@ -304,8 +855,236 @@ class Pencil:
         self.LHS = zeros_with_pattern(*LHS_matrices.values()).tocsr()
         # Store expanded matrices for fast combination
         for name, matrix in LHS_matrices.items():
-            matrix = expand_pattern(matrix, self.LHS)
-            setattr(self, name+'_exp', matrix.tocsr().copy())
+            setattr(self, name+'_exp', share_pattern(matrix, self.LHS))
+
+    def _store_truncated(self, name, matrix, cutoff):
+        """Store matrix with entries below the cutoff removed."""
+        truncated = matrix.tocsr(copy=True)
+        truncated.data[np.abs(truncated.data) < cutoff] = 0
+        truncated.eliminate_zeros()
+        setattr(self, name, truncated)
+        return truncated
+
+    def _build_equation_blocks(self, problem, names, eq, PL, cacheid=None):
+        """Build left-preconditioned COO blocks of an equation for each variable."""
+        zdtype = self.domain.bases[-1].coeff_dtype
+        PL_Zero_coo = sparse.coo_matrix(PL.shape, dtype=zdtype)
+        PL_coo = PL.tocoo()
+        blocks = {}
+        for name in names:
+            eq_expr, eq_vars = eq[name]
+            if eq_expr != 0:
+                Ei = eq_expr.operator_dict(self.global_index, eq_vars, cacheid=cacheid, **problem.ncc_kw)
+            else:
+                Ei = defaultdict(int)
+            eq_blocks = []
+            for j in range(problem.nvars):
+                # Build equation terms
+                Eij = Ei[eq_vars[j]]
+                if np.isscalar(Eij):
+                    if Eij == 0:
+                        Eij = PL_Zero_coo
+                    elif Eij == 1:
+                        Eij = PL_coo
+                    else:
+                        Eij = PL_coo * Eij
+                else:
+                    Eij = (PL @ Eij).tocoo()
+                eq_blocks.append(Eij)
+            blocks[name] = eq_blocks
+        return blocks
+
+
+class CoupledTemplate:
+    """
+    Shared structure of coupled pencil matrices.
+
+    Pencils with the same equation selection share their preconditioners and
+    permutations, and differ only in the blocks of equations containing
+    separable operators.  The template stores the CSR patterns of the pencil
+    matrices, the entries of the wavenumber-independent blocks, and the
+    positions of the wavenumber-dependent blocks in the CSR data.  Pencils
+    whose varying blocks match the template's block patterns are then built
+    by only scattering these blocks into the stored data.
+
+    Parameters
+    ----------
+    problem : problem object
+        Problem describing the pencil matrices
+    names : list of str
+        Names of the pencil matrices
+    LHS_blocks : dict
+        COO matrix blocks of the template pencil for each matrix name
+    varying_eqs : list of tuples
+        Wavenumber-dependent equations, with their left preconditioner and
+        block row index
+    left_perm : int array
+        Left permutation of the template pencil
+    pre_left, pre_right : sparse matrices
+        Preconditioners of the template pencil
+
+    Notes
+    -----
+    The stored patterns keep the explicit zeros of the template pencil, and
+    the expanded matrices use the pattern of the untruncated matrices, so
+    all pencils filling a template share the index arrays of one LHS pattern.
+
+    """
+
+    def __init__(self, problem, names, LHS_blocks, varying_eqs, left_perm, pre_left, pre_right):
+        self.names = list(names)
+        self.varying_eqs = varying_eqs
+        self.pre_left = pre_left
+        self.pre_right = pre_right
+        self.valid = True
+        # Map block rows to matrix rows under the left permutation
+        row_map = np.empty_like(left_perm)
+        row_map[left_perm] = np.arange(left_perm.size)
+        PR = pre_right.tocsr()
+        self.shape = None
+        self.patterns = {}
+        self.data = {}
+        self.source_data = {}
+        self.positions = {}
+        exp_rows = {}
+        exp_cols = {}
+        exp_weights = {}
+        exp_sources = {}
+        for name in names:
+            # Concatenate blocks, recording their data ranges
+            rows, cols, data = [], [], []
+            ranges = {}
+            n0 = i0 = j0 = 0
+            for bi, blockrow in enumerate(LHS_blocks[name]):
+                j0 = 0
+                for bj, block in enumerate(blockrow):
+                    ranges[bi, bj] = (n0, n0 + block.nnz)
+                    rows.append(block.row + i0)
+                    cols.append(block.col + j0)
+                    data.append(block.data)
+                    n0 += block.nnz
+                    j0 += block.shape[1]
+                i0 += block.shape[0]
+            self.shape = shape = (i0, j0)
+            rows = row_map[np.concatenate(rows).astype(int)]
+            cols = np.concatenate(cols).astype(int)
+            data = np.concatenate(data)
+            # Sort into CSR order
+            order = np.lexsort((cols, rows))
+            rows = rows[order]
+            cols = cols[order]
+            keys = rows * shape[1] + cols
+            if np.any(keys[1:] == keys[:-1]):
+                self.valid = False
+                return
+            position = np.empty_like(order)
+            position[order] = np.arange(order.size)
+            indptr = np.searchsorted(rows, np.arange(shape[0]+1))
+            self.patterns[name] = (cols.astype(np.int32), indptr.astype(np.int32))
+            # Store constant entries and positions of varying blocks
+            data = data[order]
+            self.source_data[name] = data.copy()
+            for eq, PL, bi in varying_eqs:
+                for bj, block in enumerate(LHS_blocks[name][bi]):
+                    n0, n1 = ranges[bi, bj]
+                    pos = position[n0:n1]
+                    data[pos] = 0
+                    self.positions[name, bi, bj] = (block.row.copy(), block.col.copy(), pos)
+            self.data[name] = data
+            # Expand right preconditioning: entries of M @ PR from entries of M
+            counts = np.diff(PR.indptr)[cols]
+            sources = np.repeat(np.arange(cols.size), counts)
+            starts = np.repeat(PR.indptr[cols] - np.cumsum(counts) + counts, counts)
+            pr_index = starts + np.arange(counts.sum())
+            exp_rows[name] = rows[sources]
+            exp_cols[name] = PR.indices[pr_index].astype(int)
+            exp_weights[name] = PR.data[pr_index]
+            exp_sources[name] = sources
+        # Union pattern of expanded matrices
+        self.exp_shape = exp_shape = (self.shape[0], PR.shape[1])
+        exp_keys = {name: exp_rows[name] * exp_shape[1] + exp_cols[name] for name in names}
+        union = np.unique(np.concatenate(list(exp_keys.values())))
+        union_rows, union_cols = np.divmod(union, exp_shape[1])
+        self.exp_pattern = (union_cols.astype(np.int32), np.searchsorted(union_rows, np.arange(exp_shape[0]+1)).astype(np.int32))
+        self.exp_maps = {}
+        for name in names:
+            targets = np.searchsorted(union, exp_keys[name])
+            exp_map = sparse.coo_matrix((exp_weights[name], (targets, exp_sources[name])), shape=(union.size, self.data[name].size))
+            self.exp_maps[name] = exp_map.tocsr()
+        self.exp_dtype = np.result_type(PR.dtype, *[data.dtype for data in self.data.values()])
+
+    def apply(self, pencil, varying_blocks, entry_cutoff):
+        """
+        Build pencil matrices from the template and the pencil's varying
+        equation blocks (keyed by block row), returning False if the blocks
+        do not match the template patterns.
+        """
+        for eq, PL, bi in self.varying_eqs:
+            for name in self.names:
+                for bj, block in enumerate(varying_blocks[bi][name]):
+                    row, col, pos = self.positions[name, bi, bj]
+                    if not (np.array_equal(block.row, row) and np.array_equal(block.col, col)):
+                        return False
+        data = {name: self.data[name].copy() for name in self.names}
+        for eq, PL, bi in self.varying_eqs:
+            for name in self.names:
+                for bj, block in enumerate(varying_blocks[bi][name]):
+                    row, col, pos = self.positions[name, bi, bj]
+                    data[name][pos] = block.data
+        self.fill(pencil, data, entry_cutoff)
+        return True
+
+    def fill_source(self, pencil, entry_cutoff):
+        """Build matrices of the pencil the template was built from."""
+        self.fill(pencil, self.source_data, entry_cutoff)
+        self.source_data = None
+
+    def fill(self, pencil, data, entry_cutoff):
+        """Store pencil matrices from template data."""
+        pencil.pre_left = self.pre_left
+        pencil.pre_right = self.pre_right
+        exp_indices, exp_indptr = self.exp_pattern
+        for name in self.names:
+            indices, indptr = self.patterns[name]
+            # Store truncated matrix
+            matrix = sparse.csr_matrix((data[name].copy(), indices.copy(), indptr.copy()), shape=self.shape)
+            matrix.eliminate_zeros()
+            pencil._store_truncated(name, matrix, entry_cutoff)
+            # Store expanded right-preconditioned matrix, sharing the template pattern
+            truncated = data[name].copy()
+            truncated[np.abs(truncated) < entry_cutoff] = 0
+            exp_data = (self.exp_maps[name] @ truncated).astype(self.exp_dtype, copy=False)
+            matrix = sparse.csr_matrix((exp_data, exp_indices, exp_indptr), shape=self.exp_shape)
+            setattr(pencil, name+'_exp', matrix)
+        exp_zeros = np.zeros(exp_indices.size, dtype=self.exp_dtype)
+        pencil.LHS = sparse.csr_matrix((exp_zeros, exp_indices, exp_indptr), shape=self.exp_shape)
+
+
+def left_preconditioner(zbasis, eq):
+    """Build left preconditioner block of an equation."""
+    if eq['LHS'].meta[zbasis.name]['constant']:
+        return zbasis.DropNonfirst
+    elif eq['tau'] and eq['differential']:
+        return zbasis.PreconditionDropTau(eq['tau'])
+    elif eq['tau']:
+        return zbasis.DropTau(eq['tau'])
+    elif eq['differential']:
+        return zbasis.PreconditionDropMatch
+    else:
+        return zbasis.DropMatch
+
+
+def depends_on_pencil(expr):
+    """Check if an expression contains separable operators, which depend on the transverse indices."""
+    if isinstance(expr, Separable):
+        return True
+    return any(depends_on_pencil(arg) for arg in getattr(expr, 'args', ()))
+
+
+def share_pattern(matrix, pattern):
+    """Expand matrix to the pattern of a CSR matrix, sharing its index arrays."""
+    matrix = expand_pattern(matrix, pattern).tocsr()
+    return sparse.csr_matrix((matrix.data, pattern.indices, pattern.indptr), shape=pattern.shape)
 
 
 def fast_bmat(blocks):
@@ -344,6 +1123,7 @@ def sparse_perm(perm, M):
     return sparse.coo_matrix((data, (row, col)), shape=(M, N))
 
 
+@CachedFunction
 def simple_reorder(N0, N1):
     # Simple permutation
     indeces = np.arange(N0 * N1)
@@ -357,46 +1137,35 @@ def left_permutation(zbasis, n_vars, eqs):
     Left permutation keeping match rows first, and inverting equation nesting:
         Input: Equations > Subbases > modes
         Output: Modes > Subbases > Equations
+    Returns the input row index of each output row.
     """
+    eq_sizes = tuple((bool(eq['LHS'].meta[zbasis.name]['constant']), eq['tau']) for eq in eqs)
+    return _left_permutation(zbasis, n_vars, eq_sizes)
+
+
+@CachedFunction
+def _left_permutation(zbasis, n_vars, eq_sizes):
+    """Build left permutation from equation constancy and tau sizes."""
     nmatch = n_vars * (len(zbasis.subbases) - 1)
-    # Compute list heirarchy of indeces
-    i = i0 = nmatch
-    L0 = []
-    for eq in eqs:
-        L1 = []
+    # Compute number of coefficients for each equation and subbasis
+    sizes = []
+    for constant, tau in eq_sizes:
+        eq_row = []
         for subbasis in zbasis.subbases:
-            L2 = []
-            # Determine number of coefficients
-            if eq['LHS'].meta[zbasis.name]['constant']:
+            if constant:
                 if (subbasis is zbasis.subbases[0]):
                     coeff_size = 1
                 else:
                     coeff_size = 0
             elif subbasis is zbasis.subbases[-1]:
-                coeff_size = subbasis.coeff_size - eq['tau']
+                coeff_size = subbasis.coeff_size - tau
             else:
                 coeff_size = subbasis.coeff_size - 1
-            # Record indeces
-            for coeff in range(coeff_size):
-                L2.append(i)
-                i += 1
-            L1.append(L2)
-        L0.append(L1)
-    # Reverse list hierarchy
-    indeces = []
-    for i in range(i0):
-        indeces.append(i)
-    n1max = len(L0)
-    n2max = max(len(L1) for L1 in L0)
-    n3max = max(len(L2) for L1 in L0 for L2 in L1)
-    for n3 in range(n3max):
-        for n2 in range(n2max):
-            for n1 in range(n1max):
-                try:
-                    indeces.append(L0[n1][n2][n3])
-                except IndexError:
-                    continue
-    return sparse_perm(indeces, len(indeces)).T.tocsr()
+            eq_row.append(coeff_size)
+        sizes.append(eq_row)
+    indices = np.concatenate([np.arange(nmatch), invert_nesting(sizes, offset=nmatch)])
+    indices.flags.writeable = False
+    return indices
 
 
 def right_permutation(zbasis, problem):
@@ -404,36 +1173,54 @@ def right_permutation(zbasis, problem):
     Right permutation inverting variable nesting:
         Input: Variables > Subbases > modes
         Output: Modes > Subbases > Variables
+    Returns the input column index of each output column.
     """
-    # Compute list heirarchy of indeces
-    i = 0
-    L0 = []
-    for var in problem.variables:
-        L1 = []
-        for subbasis in zbasis.subbases:
-            L2 = []
-            # Determine number of coefficients
-            if problem.meta[var][zbasis.name]['constant']:
-                coeff_size = 1
-            else:
-                coeff_size = subbasis.coeff_size
-            # Record indeces
-            for coeff in range(coeff_size):
-                L2.append(i)
-                i += 1
-            L1.append(L2)
-        L0.append(L1)
-    # Reverse list hierarchy
-    indeces = []
-    L1max = len(L0)
-    L2max = max(len(L1) for L1 in L0)
-    L3max = max(len(L2) for L1 in L0 for L2 in L1)
-    for n3 in range(L3max):
-        for n2 in range(L2max):
-            for n1 in range(L1max):
-                try:
-                    indeces.append(L0[n1][n2][n3])
-                except IndexError:
-                    continue
-    return sparse_perm(indeces, len(indeces)).tocsr()
+    var_constant = tuple(bool(problem.meta[var][zbasis.name]['constant']) for var in problem.variables)
+    return _right_permutation(zbasis, var_constant)
+
+
+@CachedFunction
+def _right_permutation(zbasis, var_constant):
+    """Build right permutation from variable constancy."""
+    # Compute number of coefficients for each variable and subbasis
+    sizes = []
+    for constant in var_constant:
+        if constant:
+            sizes.append([1 for subbasis in zbasis.subbases])
+        else:
+            sizes.append([subbasis.coeff_size for subbasis in zbasis.subbases])
+    indices = invert_nesting(sizes)
+    indices.flags.writeable = False
+    return indices
+
+
+def invert_nesting(sizes, offset=0):
+    """
+    Reorder consecutive indices nested as Outer > Middle > Inner to the
+    nesting Inner > Middle > Outer, skipping missing entries.
+
+    Parameters
+    ----------
+    sizes : array-like of ints, shape (n_outer, n_middle)
+        Number of inner indices in each outer and middle group
+    offset : int, optional
+        First index (default: 0)
+
+    """
+    sizes = np.array(sizes, dtype=int).reshape(len(sizes), -1)
+    counts = sizes.ravel()
+    n1, n2 = np.indices(sizes.shape)
+    n1 = np.repeat(n1.ravel(), counts)
+    n2 = np.repeat(n2.ravel(), counts)
+    n3 = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return offset + np.lexsort((n1, n2, n3))
+
 
+def permute_columns(matrix, perm):
+    """Permute matrix columns, taking output column j from input column perm[j]."""
+    matrix = matrix.tocoo()
+    inverse = np.empty_like(perm)
+    inverse[perm] = np.arange(perm.size)
+    matrix = sparse.csr_matrix((matrix.data, (matrix.row, inverse[matrix.col])), shape=(matrix.shape[0], perm.size))
+    matrix.sort_indices()
+    return matrix
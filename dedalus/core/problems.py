@@ -142,6 +142,7 @@ class ProblemBase:
         """Split and store equation and condition strings."""
         temp['raw_equation'] = equation
         temp['raw_condition'] = condition
+        temp['condition'] = parsing.vectorize_condition(condition)
         temp['raw_LHS'], temp['raw_RHS'] = parsing.split_equation(equation)
         logger.debug("  Condition: {}".format(condition))
         logger.debug("  LHS string form: {}".format(temp['raw_LHS']))
@@ -308,6 +309,88 @@ class ProblemBase:
         logger.debug('  {} linear form: {}'.format(name, str(expr)))
         return (expr, vars)
 
+    def split_parameters(self, name):
+        """
+        Split a matrix expression of all equations into pieces weighted by
+        products of scalar parameters, e.g. L = L0 + Ra*L1 + Pr*L2.
+
+        Parameters
+        ----------
+        name : str
+            Name of the matrix expressions to split (e.g. 'L')
+
+        Returns
+        -------
+        pieces : list of (str, tuple) pairs
+            Names of the piece expressions, stored in each equation dictionary,
+            and the parameters (scalar operands) whose product weights each piece
+
+        Notes
+        -----
+        Terms whose parameter dependence is not a product of scalar parameters,
+        and terms with non-constant coefficients, remain in the unweighted piece
+        and are rebuilt with that piece.  This keeps the NCC truncation of the
+        pieces the same as for the full matrices.
+
+        """
+        params = [self.namespace[param] for param in self.parameters]
+        params = [param for param in params if isinstance(param, field.Scalar)]
+        def is_param(expr):
+            return any(expr is param for param in params)
+        def has_param(expr):
+            return isinstance(expr, Operand) and any(is_param(atom) for atom in expr.atoms(field.Scalar))
+        def has_ncc(expr, vars):
+            if not isinstance(expr, Operand):
+                return False
+            return any(all(atom is not var for var in vars) for atom in expr.atoms(field.Field, field.Array))
+        def peel(expr):
+            # Split product into parameter factors and remainder (None if unity)
+            if is_param(expr):
+                return [expr], None
+            if isinstance(expr, operators.Multiply):
+                weight0, rest0 = peel(expr.args[0])
+                weight1, rest1 = peel(expr.args[1])
+                if rest0 is None:
+                    return weight0 + weight1, rest1
+                if rest1 is None:
+                    return weight0 + weight1, rest0
+                if weight0 or weight1:
+                    return weight0 + weight1, rest0 * rest1
+            return [], expr
+        def terms(expr):
+            if isinstance(expr, operators.Add):
+                return terms(expr.args[0]) + terms(expr.args[1])
+            return [expr]
+        # Collect terms by parameter weights
+        weights = [()]
+        eq_terms = []
+        for eq in self.eqs:
+            expr, vars = eq[name]
+            collected = {}
+            if expr != 0:
+                for term in terms(expr):
+                    weight, rest = peel(term)
+                    if (rest is None) or has_param(rest) or has_ncc(rest, vars):
+                        weight, rest = [], term
+                    weight = tuple(sorted(weight, key=lambda param: param.name))
+                    if weight not in weights:
+                        weights.append(weight)
+                    collected.setdefault(weight, []).append(rest)
+            eq_terms.append(collected)
+        # Store piece expressions
+        pieces = []
+        for k, weight in enumerate(weights):
+            piece = '{}{}'.format(name, k)
+            for eq, collected in zip(self.eqs, eq_terms):
+                vars = eq[name][1]
+                if weight in collected:
+                    expr = sum(collected[weight][1:], collected[weight][0])
+                    eq[piece] = self._prep_linear_form(expr, vars, name=piece)
+                else:
+                    eq[piece] = (0, vars)
+            pieces.append((piece, weight))
+        return pieces
+
     def build_solver(self, *args, **kw):
         """Build corresponding solver class."""
         return self.solver_class(self, *args, **kw)
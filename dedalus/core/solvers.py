@@ -6,6 +6,9 @@ Classes for solving differential equations.
 from mpi4py import MPI
 import numpy as np
 import time
+import os
+import json
+import hashlib
 import pathlib
 import h5py
 import uuid
@@ -19,15 +22,21 @@ from . import timesteppers
 from .evaluator import Evaluator
 from .system import FieldSystem
 from .field import Scalar, Field
-from ..libraries.matsolvers import matsolvers
+from ..libraries.matsolvers import matsolvers, apply_reordering, autotune
 from ..tools.cache import CachedAttribute
 from ..tools.progress import log_progress
 from ..tools.sparse import scipy_sparse_eigs
+from ..tools.sparse import split_scaled_selection
 from ..tools.config import config
 
 import logging
 logger = logging.getLogger(__name__.split('.')[-1])
 
+MATRIX_REORDERING = config['linear algebra'].get('MATRIX_REORDERING', 'none').lower()
+BATCHED_FACTORIZER = config['linear algebra'].get('BATCHED_FACTORIZER', 'none')
+AUTOTUNE_CANDIDATES = [name.strip() for name in config['linear algebra'].get('AUTOTUNE_CANDIDATES').split(',')]
+AUTOTUNE_CACHE_FILE = config['linear algebra'].get('AUTOTUNE_CACHE_FILE')
+
 
 class EigenvalueSolver:
     """
@@ -58,12 +67,13 @@ class EigenvalueSolver:
         logger.debug('Beginning EVP instantiation')
         if matsolver is None:
             # Default to factorizer to speed up solves within the Arnoldi iteration
-            matsolver = matsolvers[config['linear algebra']['MATRIX_FACTORIZER'].lower()]
+            matsolver = config['linear algebra']['MATRIX_FACTORIZER']
         self.problem = problem
         self.domain = domain = problem.domain
-        self.matsolver = matsolver
-        # Build pencils and pencil matrices
+        self.matsolver = lookup_matsolver(matsolver)
+        # Build pencils and parameter-weighted matrix pieces
         self.pencils = pencil.build_pencils(domain)
+        self.parameter_pieces = pencil.ParameterPieces(problem, ['M', 'L'])
         # Build systems
         namespace = problem.namespace
         vars = [namespace[var] for var in problem.variables]
@@ -92,7 +102,7 @@ class EigenvalueSolver:
             cacheid = uuid.uuid4()
         else:
             cacheid = None
-        pencil.build_matrices(self.problem, ['M', 'L'], cacheid=cacheid)
+        self.parameter_pieces.build_pencil_matrices(pencil, cacheid=cacheid)
         # Solve as dense general eigenvalue problem
         eig_output = eig(pencil.L_exp.A, b=-pencil.M_exp.A, **kw)
         # Unpack output
@@ -129,10 +139,13 @@ class EigenvalueSolver:
             cacheid = uuid.uuid4()
         else:
             cacheid = None
-        pencil.build_matrices(self.problem, ['M', 'L'], cacheid=cacheid)
+        self.parameter_pieces.build_pencil_matrices(pencil, cacheid=cacheid)
         # Solve as sparse general eigenvalue problem
         A = pencil.L_exp
         B = -pencil.M_exp
+        if self.matsolver == 'auto':
+            # Tune on the shifted matrix for this process only
+            self.matsolver = autotune_matsolver(self, [A - target*B], local=True)
         self.eigenvalues, self.eigenvectors = scipy_sparse_eigs(A=A, B=B, N=N, target=target, matsolver=self.matsolver, **kw)
         if pencil.pre_right is not None:
             self.eigenvectors = pencil.pre_right @ self.eigenvectors
@@ -181,15 +194,20 @@ class LinearBoundaryValueSolver:
 
         if matsolver is None:
             # Default to factorizer to speed up repeated solves
-            matsolver = matsolvers[config['linear algebra']['MATRIX_FACTORIZER'].lower()]
+            matsolver = config['linear algebra']['MATRIX_FACTORIZER']
         self.problem = problem
         self.domain = domain = problem.domain
-        self.matsolver = matsolver
+        self.matsolver = lookup_matsolver(matsolver)
 
         # Build pencils and pencil matrices
         self.pencils = pencil.build_pencils(domain)
         pencil.build_matrices(self.pencils, problem, ['L'])
+        if self.matsolver == 'auto':
+            self.matsolver = autotune_matsolver(self, representative_matrices(self.pencils, lambda p: p.L_exp, ['L_exp']))
+        log_pencil_bandwidths(self)
         self._build_pencil_matsolvers()
+        # Parameter-weighted matrix pieces, built on first rebuild
+        self.parameter_pieces = None
 
         # Build systems
         namespace = problem.namespace
@@ -217,9 +235,11 @@ class LinearBoundaryValueSolver:
         # Compute RHS
         self.evaluator.evaluate_group('F')
 
-        # Rebuild matrices
+        # Rebuild matrices by recombining parameter-weighted pieces
         if rebuild_coeffs:
-            pencil.build_matrices(self.pencils, self.problem, ['L'])
+            if self.parameter_pieces is None:
+                self.parameter_pieces = pencil.ParameterPieces(self.problem, ['L'])
+            self.parameter_pieces.build_matrices(self.pencils)
             self._build_pencil_matsolvers()
 
         # Solve system for each pencil, updating state
@@ -256,10 +276,10 @@ class NonlinearBoundaryValueSolver:
 
         if matsolver is None:
             # Default to solver since every iteration sees a new matrix
-            matsolver = matsolvers[config['linear algebra']['MATRIX_SOLVER'].lower()]
+            matsolver = config['linear algebra']['MATRIX_SOLVER']
         self.problem = problem
         self.domain = domain = problem.domain
-        self.matsolver = matsolver
+        self.matsolver = lookup_matsolver(matsolver)
         self.iteration = 0
 
         # Build pencils and pencil matrices
@@ -291,7 +311,10 @@ class NonlinearBoundaryValueSolver:
         # Compute RHS
         self.evaluator.evaluate_group('F', iteration=self.iteration)
         # Recompute Jacobian
-        pencil.build_matrices(self.pencils, self.problem, ['dF'])
+        pencil.build_matrices(self.pencils, self.problem, ['dF'], cache=False)
+        if self.matsolver == 'auto':
+            # Tune on the first Jacobian
+            self.matsolver = autotune_matsolver(self, representative_matrices(self.pencils, lambda p: p.L_exp - p.dF_exp, ['L_exp', 'dF_exp']))
         # Solve system for each pencil, updating perturbations
         for p in self.pencils:
             A = p.L_exp - p.dF_exp
@@ -320,6 +343,9 @@ class InitialValueSolver:
         Timestepper to use in evolving initial conditions
     matsolver : matsolver class or name, optional
         Matrix solver routine (default set by config file).
+    LHS_cache_size : int, optional
+        Number of LHS factorizations to cache for reuse when timesteps repeat
+        (default set by config file).
 
     Attributes
     ----------
@@ -340,22 +366,49 @@ class InitialValueSolver:
 
     """
 
-    def __init__(self, problem, timestepper, matsolver=None):
+    def __init__(self, problem, timestepper, matsolver=None, LHS_cache_size=None):
 
         logger.debug('Beginning IVP instantiation')
 
         if matsolver is None:
-            # Default to factorizer to speed up repeated solves
-            matsolver = matsolvers[config['linear algebra']['MATRIX_FACTORIZER'].lower()]
+            if (BATCHED_FACTORIZER.lower() != 'none') and (not problem.domain.bases[-1].coupled):
+                # Default to batched factorizer to solve uncoupled pencil groups together
+                matsolver = BATCHED_FACTORIZER
+            else:
+                # Default to factorizer to speed up repeated solves
+                matsolver = config['linear algebra']['MATRIX_FACTORIZER']
         self.problem = problem
         self.domain = domain = problem.domain
-        self.matsolver = matsolver
+        self.matsolver = lookup_matsolver(matsolver)
         self._float_array = np.zeros(1, dtype=float)
         self.start_time = self.get_world_time()
 
         # Build pencils and pencil matrices
         self.pencils = pencil.build_pencils(domain)
         pencil.build_matrices(self.pencils, problem, ['M', 'L'])
+        if self.matsolver == 'auto':
+            # Tune on a unit-timestep LHS
+            self.matsolver = autotune_matsolver(self, representative_matrices(self.pencils, lambda p: p.M_exp + p.L_exp, ['M_exp', 'L_exp']))
+        if not self.matsolver.batched:
+            logger.debug("{} is not batched; solving pencil groups one pencil at a time".format(self.matsolver.__name__))
+        log_pencil_bandwidths(self)
+        M_row_offsets = np.cumsum([0] + [p.M.shape[0] for p in self.pencils])
+        # Join pencil matrices for batched matvecs over all pencils,
+        # sharing their entries with the pencils to avoid holding them twice
+        self.block_matrices = pencil.build_block_matrices(self.pencils, ['M', 'L', 'pre_left', 'pre_right'], share_data=True)
+        # Apply mass matrix as a vector scaling for pencils where it is diagonal
+        # or a scaled selection, and as a matvec for the others
+        self.M_selection, self.M_remainder = split_scaled_selection(self.block_matrices['M'], M_row_offsets)
+        if self.M_selection is not None:
+            if self.M_remainder is None:
+                logger.debug("Applying mass matrix as a vector scaling")
+            else:
+                logger.debug("Applying mass matrix as a vector scaling for some pencils")
+        # Group pencils with matching LHS patterns for batched solves,
+        # sharing factorizations between pencils with identical matrices
+        self.pencil_groups = pencil.group_pencils(self.pencils, contents=['M_exp', 'L_exp'])
+        n_unique = sum(len(group.unique) for group in self.pencil_groups)
+        logger.debug("Grouped {} pencils into {} patterns with {} unique matrices".format(len(self.pencils), len(self.pencil_groups), n_unique))
 
         # Build systems
         namespace = problem.namespace
@@ -376,6 +429,8 @@ class InitialValueSolver:
             timestepper = timesteppers.schemes[timestepper]
         pencil_length = problem.nvars_nonconst * domain.local_coeff_shape[-1] + problem.nvars_const
         self.timestepper = timestepper(pencil_length, domain)
+        if LHS_cache_size is not None:
+            self.timestepper.LHS_cache.size = LHS_cache_size
 
         # Attributes
         self.sim_time = self.initial_sim_time = 0.
@@ -386,6 +441,10 @@ class InitialValueSolver:
         self.stop_wall_time = np.inf
         self.stop_iteration = np.inf
 
+        # Adaptive timestepping state
+        self._X0 = None
+        self._error_prev = 1.
+
         logger.debug('Finished IVP instantiation')
 
     @property
@@ -508,6 +567,143 @@ class InitialValueSolver:
         self.iteration += 1
         return dt
 
+    def step_adaptive(self, dt, atol=1e-6, rtol=1e-6, safety=0.9, max_change=5., min_change=0.2, max_dt=np.inf, min_dt=0., max_rejections=20, trim=True):
+        """
+        Advance system by one iteration/timestep, controlling the local error.
+
+        The step is attempted with the given timestep and repeated with smaller
+        timesteps until the embedded error estimate of the timestepper satisfies
+        the tolerances.  A PI controller then proposes the next timestep.
+
+        Parameters
+        ----------
+        dt : float
+            Timestep to attempt
+        atol : float, optional
+            Absolute tolerance on the state coefficients (default: 1e-6)
+        rtol : float, optional
+            Relative tolerance on the state coefficients (default: 1e-6)
+        safety : float, optional
+            Safety factor scaling the proposed timesteps (default: 0.9)
+        max_change : float, optional
+            Maximum fractional increase between timesteps (default: 5.)
+        min_change : float, optional
+            Minimum fractional decrease between timesteps (default: 0.2)
+        max_dt : float, optional
+            Maximum timestep (default: inf)
+        min_dt : float, optional
+            Minimum timestep, below which a rejected step raises (default: 0.)
+        max_rejections : int, optional
+            Maximum number of rejected attempts before raising (default: 20)
+        trim : bool, optional
+            Trim timestep to hit handler sim_dt cadences (default: True)
+
+        Returns
+        -------
+        dt : float
+            Proposed timestep for the next iteration
+
+        Notes
+        -----
+        The timestep taken is stored as solver.dt.  The error is measured as
+        the RMS of the coefficient errors scaled by atol + rtol*|X|, so steps
+        are accepted when this norm is at most one.  Requires a Runge-Kutta
+        timestepper with embedded weights (e.g. RK222 or RK443).  Each change
+        in timestep rebuilds the LHS factorizations, so it may be worthwhile
+        to increase LHS_cache_size when rejected steps are frequent.
+
+        Scheduled handlers are evaluated on the initial state once the step
+        is accepted, so they receive the timestep actually taken.
+
+        """
+        timestepper = self.timestepper
+        if getattr(timestepper, 'A_hat', None) is None:
+            raise ValueError("Timestepper does not provide an embedded error estimate.")
+        if not np.isfinite(dt):
+            raise ValueError("Invalid timestep")
+        exponent = 1 / (timestepper.embedded_order + 1)
+        state = self.state
+        sim_time_0 = self.sim_time
+        world_time_0 = self.get_world_time()
+        dt_requested = dt = min(dt, max_dt)
+        # Trim timestep to hit handler sim_dt cadences
+        cadences = self.sim_dt_cadences
+        if trim and cadences.size:
+            schedule = min(cadences * (sim_time_0//cadences + 1))
+            dt = min(dt, schedule - sim_time_0)
+        # (Safety gather)
+        state.gather()
+        # Save initial state for rejected steps and handler evaluation
+        if self._X0 is None:
+            self._X0 = np.zeros_like(state.data)
+            self._X1 = np.zeros_like(state.data)
+        np.copyto(self._X0, state.data)
+        rejections = 0
+        while True:
+            timestepper.step(self, dt, retry=(rejections > 0), scheduled=False)
+            error = self._error_norm(dt, atol, rtol)
+            if error <= 1:
+                break
+            # Reject step and retry with reduced timestep
+            if np.isfinite(error):
+                factor = max(min_change, safety * error**(-exponent))
+            else:
+                factor = min_change
+            logger.debug("Rejected timestep {:.3e} with error norm {:.3e}".format(dt, error))
+            np.copyto(state.data, self._X0)
+            self.sim_time = sim_time_0
+            dt *= factor
+            rejections += 1
+            if (rejections > max_rejections) or (dt < min_dt):
+                # Leave the initial state in place
+                state.scatter()
+                if rejections > max_rejections:
+                    raise ValueError("Timestep rejected {} times with error norm {:.3e}".format(rejections, error))
+                raise ValueError("Timestep {:.3e} fell below min_dt with error norm {:.3e}".format(dt, error))
+        # Evaluate scheduled handlers on the initial state with the accepted timestep
+        self._evaluate_scheduled_initial(dt, sim_time_0, world_time_0)
+        # (Safety scatter)
+        state.scatter()
+        # Update iteration
+        self.iteration += 1
+        self.dt = dt
+        # PI controller for next timestep
+        error = max(error, 1e-10)
+        factor = safety * error**(-0.7*exponent) * self._error_prev**(0.4*exponent)
+        factor = min(max(factor, min_change), max_change)
+        self._error_prev = error
+        dt_next = dt * factor
+        if rejections == 0:
+            # Trimming should not shrink later timesteps
+            dt_next = max(dt_next, dt_requested)
+        return min(dt_next, max_dt)
+
+    def _evaluate_scheduled_initial(self, dt, sim_time_0, world_time_0):
+        """Evaluate scheduled non-RHS handlers on the saved initial state of an accepted step."""
+        handlers = [h for h in self.evaluator.handlers if h.group != 'F']
+        if not handlers:
+            return
+        state = self.state
+        sim_time_1 = self.sim_time
+        np.copyto(self._X1, state.data)
+        np.copyto(state.data, self._X0)
+        state.scatter()
+        self.sim_time = sim_time_0
+        self.evaluator.evaluate_scheduled(handlers=handlers, world_time=world_time_0, wall_time=world_time_0-self.start_time,
+                                          sim_time=sim_time_0, timestep=dt, iteration=self.iteration)
+        np.copyto(state.data, self._X1)
+        self.sim_time = sim_time_1
+
+    def _error_norm(self, dt, atol, rtol):
+        """Compute the scaled RMS norm of the embedded error estimate of the last step."""
+        self.timestepper.estimate_error(self, dt)
+        error = self.timestepper.error.data
+        scale = atol + rtol * np.maximum(np.abs(self._X0), np.abs(self.state.data))
+        sums = np.array([np.sum(np.abs(error / scale)**2), error.size], dtype=float)
+        comm = self.domain.dist.comm_cart
+        comm.Allreduce(MPI.IN_PLACE, sums, op=MPI.SUM)
+        return np.sqrt(sums[0] / sums[1])
+
     def evolve(self, timestep_function):
         """Advance system until stopping criterion is reached."""
 
@@ -539,3 +735,92 @@ class InitialValueSolver:
         self.evaluator.evaluate_handlers(handlers, timestep=dt, sim_time=self.sim_time, world_time=end_world_time, wall_time=end_wall_time, iteration=self.iteration)
 
 
+def log_pencil_bandwidths(solver):
+    """Log pencil LHS bandwidths, at info level when they affect the matsolver."""
+    reorder = (MATRIX_REORDERING != 'none')
+    if reorder or getattr(solver.matsolver, 'banded', False):
+        level = logging.INFO
+    else:
+        level = logging.DEBUG
+    pencil.log_bandwidths(solver.pencils, reorder=reorder, level=level)
+
+
+def lookup_matsolver(matsolver):
+    """Dereference matsolver names and apply reordering, deferring 'auto' until matrices are built."""
+    if isinstance(matsolver, str):
+        if matsolver.lower() == 'auto':
+            return 'auto'
+        matsolver = matsolvers[matsolver.lower()]
+    return apply_reordering(matsolver, MATRIX_REORDERING)
+
+
+def representative_matrices(pencils, build, names):
+    """Build the matrix of the local pencil whose named matrices have the most nonzeros."""
+    if not pencils:
+        return []
+    representative = max(pencils, key=lambda p: sum(getattr(p, name).nnz for name in names))
+    return [build(representative)]
+
+
+def autotune_key(solver):
+    """Describe the resolution and equation set determining the fastest matsolver."""
+    problem = solver.problem
+    domain = solver.domain
+    hasher = hashlib.sha1()
+    def update(*items):
+        for item in items:
+            hasher.update(repr(item).encode())
+    update(type(solver).__name__, domain.dist.comm_cart.size, AUTOTUNE_CANDIDATES, MATRIX_REORDERING)
+    update(np.dtype(domain.grid_dtype).str, [pencil.basis_signature(basis) for basis in domain.bases])
+    update(problem.variables, [(eq['raw_equation'], eq['raw_condition']) for eq in problem.eqs])
+    return hasher.hexdigest()
+
+
+def autotune_matsolver(solver, matrices, local=False):
+    """
+    Select the fastest AUTOTUNE_CANDIDATES matsolver on representative matrices.
+
+    Choices are recorded in AUTOTUNE_CACHE_FILE, if enabled, and reused by
+    later runs with the same resolution and equation set.  Unless local,
+    timings are summed over the domain processes so that all processes
+    select the same matsolver.
+    """
+    comm = None if local else solver.domain.dist.comm_cart
+    root = (comm is None or comm.rank == 0)
+    cache = (AUTOTUNE_CACHE_FILE.lower() != 'none')
+    if cache:
+        # Read cache on root only so all processes agree on hits
+        path = os.path.expanduser(AUTOTUNE_CACHE_FILE)
+        key = autotune_key(solver)
+        choices = {}
+        if root and os.path.isfile(path):
+            with open(path) as file:
+                choices = json.load(file)
+        choice = choices.get(key)
+        if comm is not None:
+            choice = comm.bcast(choice, root=0)
+        if choice is not None:
+            logger.info("Using cached matsolver choice: {}".format(choice))
+            return lookup_matsolver(choice)
+    # Time candidates
+    candidates = [lookup_matsolver(name) for name in AUTOTUNE_CANDIDATES]
+    timings = autotune(candidates, matrices, solver)
+    timings = {name: timings[candidate] for name, candidate in zip(AUTOTUNE_CANDIDATES, candidates) if candidate in timings}
+    # Keep candidates available on all processes with local matrices
+    if comm is not None:
+        all_timings = [t for t, local in zip(comm.allgather(timings), comm.allgather(bool(matrices))) if local]
+        timings = {name: sum(t[name] for t in all_timings) for name in timings if all(name in t for t in all_timings)}
+        timings = comm.bcast(timings if comm.rank == 0 else None, root=0)
+    if not timings:
+        raise ValueError("No autotuning candidates could solve the pencil matrices.")
+    name = min(timings, key=timings.get)
+    logger.info("Autotuned matsolver: {} ({})".format(name, ", ".join("{}: {:.2e} s".format(*item) for item in sorted(timings.items(), key=lambda item: item[1]))))
+    # Record choice
+    if cache and root:
+        choices[key] = name
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w') as file:
+            json.dump(choices, file, indent=4, sort_keys=True)
+        os.replace(temp_path, path)
+    return lookup_matsolver(name)
@@ -8,8 +8,15 @@ import numpy as np
 from scipy.sparse import linalg
 
 from .system import CoeffSystem
+from .combinations import linear_combination
+from ..libraries.matsolvers import build_batch
+from ..tools.config import config
+from ..tools.parallel import pool_map
 from ..tools.sparse import fast_csr_matvec
 
+FACTORIZATION_THREADS = config['linear algebra'].getint('FACTORIZATION_THREADS')
+LHS_CACHE_SIZE = config['linear algebra'].getint('LHS_CACHE_SIZE')
+
 
 # Track implemented schemes
 schemes = OrderedDict()
@@ -18,6 +25,83 @@ def add_scheme(scheme):
     return scheme
 
 
+def build_LHS_solvers(solver, a, b):
+    """Build batched solvers for the LHS matrices (a*M + b*L) of each pencil group."""
+    pencils = solver.pencils
+    # Factorize on thread pool
+    thread_map = pool_map(FACTORIZATION_THREADS)
+    LHS_solvers = []
+    for group in solver.pencil_groups:
+        # Only build LHS matrices for unique pencils in each group
+        matrices = []
+        for i in group.unique:
+            p = pencils[i]
+            np.copyto(p.LHS.data, a*p.M_exp.data + b*p.L_exp.data)
+            matrices.append(p.LHS)
+        LHS_solvers.append(build_batch(solver.matsolver, matrices, solver, map=thread_map))
+    return LHS_solvers
+
+
+def apply_M(solver, X, out):
+    """Compute M.X over all pencils, using vector scaling where possible."""
+    selection = solver.M_selection
+    remainder = solver.M_remainder
+    if selection is None:
+        out.fill(0)
+    else:
+        scales, cols = selection
+        if cols is None:
+            np.multiply(scales, X, out=out)
+        else:
+            np.take(X, cols, out=out)
+            out *= scales
+    # Add matvec for pencils without scaled mass matrices
+    if remainder is not None:
+        fast_csr_matvec(remainder, X, out)
+
+
+class LHSCache:
+    """
+    Least-recently-used cache of LHS solvers, keyed on the LHS coefficients.
+
+    Parameters
+    ----------
+    size : int
+        Maximum number of cached sets of LHS solvers
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key, build, *args):
+        """Retrieve cached solvers, or build them as build(*args)."""
+        entries = self.entries
+        if key in entries:
+            entries.move_to_end(key)
+        else:
+            # Remove old solver references before building new solvers
+            while entries and len(entries) >= self.size:
+                entries.popitem(last=False)
+            entries[key] = build(*args)
+        return entries[key]
+
+
+def solve_LHS(solver, LHS_solvers, RHS, X, out=None):
+    """Solve pencil groups for X and right-precondition into the solver state (or out)."""
+    RHS_pencils = RHS.data.reshape(-1, RHS.pencil_length)
+    X_pencils = X.data.reshape(-1, X.pencil_length)
+    for group, LHS_solver in zip(solver.pencil_groups, LHS_solvers):
+        # Duplicate pencils are solved in layers sharing the unique factorizations
+        for layer in group.layers:
+            X_pencils[layer] = LHS_solver.solve(RHS_pencils[layer])
+    if out is None:
+        out = solver.state
+    out.data.fill(0)
+    fast_csr_matvec(solver.block_matrices['pre_right'], X.data.reshape(-1), out.data.reshape(-1))
+
+
 class MultistepIMEX:
     """
     Base class for implicit-explicit multistep methods.
@@ -56,31 +140,36 @@ class MultistepIMEX:
     def __init__(self, pencil_length, domain):
 
         self.RHS = CoeffSystem(pencil_length, domain)
+        self.X = CoeffSystem(pencil_length, domain)
 
         # Create deque for storing recent timesteps
         N = max(self.amax, self.bmax, self.cmax)
         self.dt = deque([0.]*N)
 
-        # Create coefficient systems for multistep history
-        self.MX = MX = deque()
-        self.LX = LX = deque()
-        self.F = F = deque()
-        for j in range(self.amax):
-            MX.append(CoeffSystem(pencil_length, domain))
-        for j in range(self.bmax):
-            LX.append(CoeffSystem(pencil_length, domain))
-        for j in range(self.cmax):
-            F.append(CoeffSystem(pencil_length, domain))
+        # Create contiguous ring buffer for multistep history
+        # Rows hold flattened system data for M.X, L.X, and F history, in turn
+        size = self.RHS.data.size
+        dtype = self.RHS.data.dtype
+        self.history = np.zeros((self.amax+self.bmax+self.cmax, size), dtype=dtype)
+        self.MX = self.history[:self.amax]
+        self.LX = self.history[self.amax:self.amax+self.bmax]
+        self.F = self.history[self.amax+self.bmax:]
+        # Offsets of each buffer along the history axis
+        self._MX_offset = 0
+        self._LX_offset = self.amax
+        self._F_offset = self.amax + self.bmax
+        # Ring cursor: history j is stored in row (cursor + j) % length
+        self._cursor = 0
 
         # Attributes
         self._iteration = 0
-        self._LHS_params = None
+        self.LHS_cache = LHSCache(LHS_CACHE_SIZE)
 
     def step(self, solver, dt):
         """Advance solver by one timestep."""
 
         # Solver references
-        pencils = solver.pencils
+        blocks = solver.block_matrices
         evaluator = solver.evaluator
         state = solver.state
 
@@ -96,6 +185,7 @@ class MultistepIMEX:
         LX = self.LX
         F = self.F
         RHS = self.RHS
+        history = self.history
 
         # Cycle and compute timesteps
         self.dt.rotate()
@@ -109,54 +199,44 @@ class MultistepIMEX:
         state.scatter()
         evaluator.evaluate_scheduled(**evaluator_kw)
 
-        # Update RHS components and LHS matrices
-        MX.rotate()
-        LX.rotate()
-        F.rotate()
+        # Rotate history by moving the ring cursor
+        self._cursor -= 1
+        cursor = self._cursor
 
-        MX0 = MX[0]
-        LX0 = LX[0]
-        F0 = F[0]
+        MX0 = MX[cursor % self.amax]
+        LX0 = LX[cursor % self.bmax]
+        F0 = F[cursor % self.cmax]
         a0 = a[0]
         b0 = b[0]
 
-        # Check on updating LHS
-        update_LHS = ((a0, b0) != self._LHS_params)
-        self._LHS_params = (a0, b0)
-
-        # Update MX0, LX0, F0
-        MX0.data.fill(0)
-        LX0.data.fill(0)
-        F0.data.fill(0)
-        for p in pencils:
-            x = state.get_pencil(p)
-            fast_csr_matvec(p.M, x, MX0.get_pencil(p))
-            fast_csr_matvec(p.L, x, LX0.get_pencil(p))
-            fast_csr_matvec(p.pre_left, solver.F.get_pencil(p), F0.get_pencil(p))
-
-        # Build RHS
-        RHS.data.fill(0)
+        # Update MX0, LX0, F0 with batched matvecs over all pencils
+        LX0.fill(0)
+        F0.fill(0)
+        X = state.data.reshape(-1)
+        apply_M(solver, X, MX0)
+        fast_csr_matvec(blocks['L'], X, LX0)
+        fast_csr_matvec(blocks['pre_left'], solver.F.data.reshape(-1), F0)
+
+        # Build RHS by contracting the history axis, skipping vanishing terms
+        coeffs = []
+        rows = []
         for j in range(1, len(c)):
-            RHS.data += c[j] * F[j-1].data
+            if c[j]:
+                coeffs.append(c[j])
+                rows.append(self._F_offset + (cursor + j-1) % self.cmax)
         for j in range(1, len(a)):
-            RHS.data -= a[j] * MX[j-1].data
+            if a[j]:
+                coeffs.append(-a[j])
+                rows.append(self._MX_offset + (cursor + j-1) % self.amax)
         for j in range(1, len(b)):
-            RHS.data -= b[j] * LX[j-1].data
+            if b[j]:
+                coeffs.append(-b[j])
+                rows.append(self._LX_offset + (cursor + j-1) % self.bmax)
+        linear_combination(RHS.data.reshape(-1), np.array(coeffs, dtype=np.float64), [history[r] for r in rows])
 
         # Solve
-        state.data.fill(0)
-        for p in pencils:
-            pRHS = RHS.get_pencil(p)
-            if update_LHS:
-                np.copyto(p.LHS.data, a0*p.M_exp.data + b0*p.L_exp.data)
-                # Remove old solver reference before building new solver
-                p.LHS_solver = None
-                p.LHS_solver = solver.matsolver(p.LHS, solver)
-            pX = p.LHS_solver.solve(pRHS)
-            if p.pre_right is None:
-                state.set_pencil(p, pX)
-            else:
-                fast_csr_matvec(p.pre_right, pX, state.get_pencil(p))
+        LHS_solvers = self.LHS_cache.get((a0, b0), build_LHS_solvers, solver, a0, b0)
+        solve_LHS(solver, LHS_solvers, RHS, self.X)
 
         # Update solver
         solver.sim_time += dt
@@ -495,28 +575,55 @@ class RungeKuttaIMEX:
         b_ex = A[s, :]
         c[s] = 1
 
+    Schemes with embedded weights (A_hat, H_hat) provide a local error estimate
+    from a lower-order solution sharing the final-stage LHS:
+        (M + k Hss L).X^(n+1) = M.X(n,0) + k A_hat_j F(n,j) - k H_hat_j L.X(n,j)
+    where j runs from 0 to s-1.  The difference from the advanced solution,
+        (M + k Hss L).(X(n,s) - X^(n+1)) = k (Asj - A_hat_j) F(n,j) - k (Hsj - H_hat_j) L.X(n,j)
+    only requires one additional solve with the existing final-stage factorization.
+    Since the mass matrix is generally singular, the embedded weights are chosen
+    with H_hat_0 = 0 so that the embedded solution remains L-stable and stiff modes
+    do not pollute the estimate.
+
     References
     ----------
     U. M. Ascher, S. J. Ruuth, and R. J. Spiteri, Applied Numerical Mathematics (1997).
 
     """
 
+    # Embedded weights for schemes providing error estimates
+    A_hat = None
+    H_hat = None
+    embedded_order = None
+
     def __init__(self, pencil_length, domain):
 
         self.RHS = CoeffSystem(pencil_length, domain)
+        self.X = CoeffSystem(pencil_length, domain)
 
         # Create coefficient systems for multistep history
         self.MX0 = CoeffSystem(pencil_length, domain)
         self.LX = LX = [CoeffSystem(pencil_length, domain) for i in range(self.stages)]
         self.F = F = [CoeffSystem(pencil_length, domain) for i in range(self.stages)]
 
-        self._LHS_params = None
+        # Create coefficient system for embedded error estimate
+        if self.A_hat is not None:
+            self.error = CoeffSystem(pencil_length, domain)
 
-    def step(self, solver, dt):
-        """Advance solver by one timestep."""
+        self.LHS_cache = LHSCache(LHS_CACHE_SIZE)
+
+    def step(self, solver, dt, retry=False, scheduled=True):
+        """
+        Advance solver by one timestep.
+
+        Retried steps reuse the first-stage evaluations, which are unchanged
+        when the state and time have been restored after a rejected step.
+        Without scheduled, only the F group is evaluated at the first stage,
+        leaving the scheduled handlers to the caller.
+        """
 
         # Solver references
-        pencils = solver.pencils
+        blocks = solver.block_matrices
         evaluator = solver.evaluator
         state = solver.state
 
@@ -537,56 +644,76 @@ class RungeKuttaIMEX:
         c = self.c
         k = dt
 
-        # Check on updating LHS
-        update_LHS = (k != self._LHS_params)
-        self._LHS_params = k
+        # Retrieve or build stage LHS solvers
+        LHS_solvers = self.LHS_cache.get(k, self.build_stage_solvers, solver, k)
 
         # Compute M.X(n,0)
-        MX0.data.fill(0)
-        for p in pencils:
-            fast_csr_matvec(p.M, state.get_pencil(p), MX0.get_pencil(p))
-            if update_LHS:
-                p.LHS_solvers = [None] * (self.stages+1)
+        if not retry:
+            apply_M(solver, state.data.reshape(-1), MX0.data.reshape(-1))
 
         # Compute stages
         # (M + k Hii L).X(n,i) = M.X(n,0) + k Aij F(n,j) - k Hij L.X(n,j)
         for i in range(1, self.stages+1):
 
             # Compute F(n,i-1), L.X(n,i-1)
-            state.scatter()
-            evaluator_kw['sim_time'] = solver.sim_time
-            if i == 1:
-                evaluator.evaluate_scheduled(**evaluator_kw)
-            else:
-                evaluator.evaluate_group('F', **evaluator_kw)
-            LX[i-1].data.fill(0)
-            F[i-1].data.fill(0)
-            for p in pencils:
-                fast_csr_matvec(p.L, state.get_pencil(p), LX[i-1].get_pencil(p))
-                fast_csr_matvec(p.pre_left, solver.F.get_pencil(p), F[i-1].get_pencil(p))
-
-            # Construct RHS(n,i)
-            np.copyto(RHS.data, MX0.data)
-            for j in range(0, i):
-                RHS.data += (k * A[i,j]) * F[j].data
-                RHS.data -= (k * H[i,j]) * LX[j].data
-
-            state.data.fill(0)
-            for p in pencils:
-                pRHS = RHS.get_pencil(p)
-                # Construct LHS(n,i)
-                if update_LHS:
-                    np.copyto(p.LHS.data, p.M_exp.data + (k*H[i,i])*p.L_exp.data)
-                    # Remove old solver reference before building new solver
-                    p.LHS_solvers[i] = None
-                    p.LHS_solvers[i] = solver.matsolver(p.LHS, solver)
-                pX = p.LHS_solvers[i].solve(pRHS)
-                if p.pre_right is None:
-                    state.set_pencil(p, pX)
+            if not (retry and i == 1):
+                state.scatter()
+                evaluator_kw['sim_time'] = solver.sim_time
+                if i == 1 and scheduled:
+                    evaluator.evaluate_scheduled(**evaluator_kw)
                 else:
-                    fast_csr_matvec(p.pre_right, pX, state.get_pencil(p))
+                    evaluator.evaluate_group('F', **evaluator_kw)
+                LX[i-1].data.fill(0)
+                F[i-1].data.fill(0)
+                fast_csr_matvec(blocks['L'], state.data.reshape(-1), LX[i-1].data.reshape(-1))
+                fast_csr_matvec(blocks['pre_left'], solver.F.data.reshape(-1), F[i-1].data.reshape(-1))
+
+            # Construct RHS(n,i) in a single pass
+            coeffs = [1]
+            arrays = [MX0.data.reshape(-1)]
+            for j in range(0, i):
+                coeffs.extend((k * A[i,j], -(k * H[i,j])))
+                arrays.extend((F[j].data.reshape(-1), LX[j].data.reshape(-1)))
+            linear_combination(RHS.data.reshape(-1), np.array(coeffs, dtype=np.float64), arrays)
+
+            # Solve (M + k Hii L).X(n,i) = RHS(n,i)
+            solve_LHS(solver, LHS_solvers[i], RHS, self.X)
             solver.sim_time = sim_time_0 + k*c[i]
 
+    def estimate_error(self, solver, dt):
+        """Compute the embedded error estimate of the last step into self.error."""
+
+        s = self.stages
+        LX = self.LX
+        F = self.F
+        k = dt
+        dA = self.A[s, :s] - self.A_hat
+        dH = self.H[s, :s] - self.H_hat
+
+        # Construct error RHS from the stage evaluations
+        coeffs = []
+        arrays = []
+        for j in range(s):
+            coeffs.extend((k * dA[j], -(k * dH[j])))
+            arrays.extend((F[j].data.reshape(-1), LX[j].data.reshape(-1)))
+        linear_combination(self.RHS.data.reshape(-1), np.array(coeffs, dtype=np.float64), arrays)
+
+        # Solve with the final-stage LHS solvers from the last step
+        LHS_solvers = self.LHS_cache.get(k, self.build_stage_solvers, solver, k)
+        solve_LHS(solver, LHS_solvers[s], self.RHS, self.X, out=self.error)
+
+    def build_stage_solvers(self, solver, k):
+        """Build LHS solvers for each stage, sharing them between stages with equal diagonals."""
+        H = self.H
+        LHS_solvers = [None] * (self.stages+1)
+        diagonal_solvers = {}
+        for i in range(1, self.stages+1):
+            Hii = H[i,i]
+            if Hii not in diagonal_solvers:
+                diagonal_solvers[Hii] = build_LHS_solvers(solver, 1, k*Hii)
+            LHS_solvers[i] = diagonal_solvers[Hii]
+        return LHS_solvers
+
 
 @add_scheme
 class RK111(RungeKuttaIMEX):
@@ -622,6 +749,11 @@ class RK222(RungeKuttaIMEX):
                   [0,  γ , 0],
                   [0, 1-γ, γ]])
 
+    # Embedded 1st-order weights (explicit Euler with the same implicit weights)
+    A_hat = np.array([1, 0])
+    H_hat = np.array([0, 1-γ])
+    embedded_order = 1
+
 
 @add_scheme
 class RK443(RungeKuttaIMEX):
@@ -643,6 +775,11 @@ class RK443(RungeKuttaIMEX):
                   [0, -1/2,  1/2, 1/2,  0 ],
                   [0,  3/2, -3/2, 1/2, 1/2]])
 
+    # Embedded 2nd-order weights (explicit midpoint with L-stable implicit weights)
+    A_hat = np.array([0, 1, 0, 0])
+    H_hat = np.array([0, 2, -3/2, 0])
+    embedded_order = 2
+
 
 @add_scheme
 class RKSMR(RungeKuttaIMEX):
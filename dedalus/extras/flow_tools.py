@@ -157,6 +157,10 @@ class CFL:
         Minimum fractional change between timesteps (default: 0.)
     threshold : float, optional
         Fractional change threshold for changing timestep (default: 0.)
+    ladder_ratio : float, optional
+        Ratio of a geometric ladder of timesteps, anchored at max_dt (if finite)
+        or initial_dt, onto which computed timesteps are snapped down, unless
+        limited by min_dt or min_change (default: None (no snapping))
 
     Notes
     -----
@@ -164,10 +168,16 @@ class CFL:
     for each grid point, and then reciprocating the maximum "total" frequency
     from the entire grid.
 
+    Snapping timesteps to a discrete ladder limits the number of distinct
+    timesteps, so that LHS factorizations cached by the timestepper (see the
+    LHS_cache_size option of the IVP solver) can be reused when the timestep
+    oscillates between neighboring values.
+
     """
 
     def __init__(self, solver, initial_dt, cadence=1, safety=1., max_dt=np.inf,
-                 min_dt=0., max_change=np.inf, min_change=0., threshold=0.):
+                 min_dt=0., max_change=np.inf, min_change=0., threshold=0.,
+                 ladder_ratio=None):
 
         self.solver = solver
         self.stored_dt = initial_dt
@@ -178,6 +188,13 @@ class CFL:
         self.max_change = max_change
         self.min_change = min_change
         self.threshold = threshold
+        if (ladder_ratio is not None) and (ladder_ratio <= 1):
+            raise ValueError("ladder_ratio must be greater than 1.")
+        self.ladder_ratio = ladder_ratio
+        if np.isfinite(max_dt):
+            self.ladder_anchor = max_dt
+        else:
+            self.ladder_anchor = initial_dt
 
         domain = solver.domain
         self.grid_spacings = []
@@ -209,10 +226,22 @@ class CFL:
             dt *= self.safety
             dt = min(dt, self.max_dt, self.max_change*self.stored_dt)
             dt = max(dt, self.min_dt, self.min_change*self.stored_dt)
+            if self.ladder_ratio is not None:
+                # Reapply lower bounds since snapping rounds down
+                dt = self.snap_to_ladder(dt)
+                dt = max(dt, self.min_dt, self.min_change*self.stored_dt)
             if abs(dt - self.stored_dt) > self.threshold * self.stored_dt:
                 self.stored_dt = dt
         return self.stored_dt
 
+    def snap_to_ladder(self, dt):
+        """Snap timestep down to the geometric timestep ladder."""
+        if not np.isfinite(dt):
+            return dt
+        # Small tolerance keeps timesteps on the ladder from dropping a rung
+        rung = np.floor(np.log(dt/self.ladder_anchor) / np.log(self.ladder_ratio) + 1e-9)
+        return self.ladder_anchor * self.ladder_ratio**int(rung)
+
     def add_frequency(self, freq):
         """Add an on-grid frequency."""
         self.frequencies.add_task(freq, layout='g')
@@ -1,10 +1,28 @@
 """Matrix solver wrappers."""
 
+from functools import partial
+import inspect
+import time
 import numpy as np
 import scipy.linalg as sla
 import scipy.sparse as sp
 import scipy.sparse.linalg as spla
 
+from ..tools.cache import CachedFunction
+from ..tools.config import config
+from ..tools.sparse import bandwidths, rcm_permutation
+
+import logging
+logger = logging.getLogger(__name__.split('.')[-1])
+
+KRYLOV_PRECONDITIONER = config['linear algebra'].get('KRYLOV_PRECONDITIONER').lower()
+KRYLOV_TOLERANCE = config['linear algebra'].getfloat('KRYLOV_TOLERANCE')
+KRYLOV_MAXITER = config['linear algebra'].getint('KRYLOV_MAXITER')
+KRYLOV_BANDWIDTH = config['linear algebra'].getint('KRYLOV_BANDWIDTH')
+ILU_DROP_TOL = config['linear algebra'].getfloat('ILU_DROP_TOL')
+ILU_FILL_FACTOR = config['linear algebra'].getfloat('ILU_FILL_FACTOR')
+# Relative tolerance keyword was renamed from 'tol' to 'rtol' in scipy 1.12
+KRYLOV_TOL_KEYWORD = 'rtol' if 'rtol' in inspect.signature(spla.gmres).parameters else 'tol'
 
 matsolvers = {}
 def add_solver(solver):
@@ -12,15 +30,54 @@ def add_solver(solver):
     return solver
 
 
+def build_batch(matsolver, matrices, solver=None, map=map):
+    """
+    Build a batched solver for a sequence of matrices.
+    Non-batched matsolvers fall back to a SequentialBatch of individual
+    solvers, built using the provided map function, e.g. from a thread pool.
+    """
+    if matsolver.batched:
+        return matsolver(matrices, solver)
+    else:
+        return SequentialBatch(list(map(partial(matsolver, solver=solver), matrices)))
+
+
+class SequentialBatch:
+    """
+    Fallback batched interface looping over individual solvers.
+    The Python overhead of solves scales with the number of matrices, so
+    batched matsolvers should be used where the matrices allow it.
+    """
+
+    def __init__(self, solvers):
+        self.solvers = solvers
+
+    def solve(self, vectors):
+        # Leading solvers are used when fewer vectors are provided
+        return np.array([s.solve(v) for s, v in zip(self.solvers, vectors)])
+
+    def solve_many(self, vectors):
+        return np.array([s.solve_many(v) for s, v in zip(self.solvers, vectors)])
+
+
 class SolverBase:
     """Abstract base class for all solvers."""
 
+    batched = False
+    # Solvers relying on the original ordering (e.g. block structure) disable this
+    reorderable = True
+
     def __init__(self, matrix, solver=None):
         pass
 
     def solve(self, vector):
         pass
 
+    def solve_many(self, vectors):
+        """Solve for multiple right-hand sides stored as the columns of a 2D array."""
+        # Fallback looping over columns
+        return np.column_stack([self.solve(vector) for vector in vectors.T])
+
 
 class SparseSolver(SolverBase):
     """Base class for sparse solvers."""
@@ -46,6 +103,70 @@ class BandedSolver(SolverBase):
         lu = (l, u)
         return lu, ab
 
+    @staticmethod
+    def sparse_to_lapack_banded(matrices):
+        """
+        Stack sparse matrices in LAPACK band storage at their joint bandwidths,
+        with kl extra rows for pivoting fill-in:
+            ab[b, kl+ku+i-j, j] = A[b][i, j]
+        """
+        coo = [matrix.tocoo() for matrix in matrices]
+        N = coo[0].shape[1]
+        # Joint bandwidths
+        offsets = np.concatenate([A.col - A.row for A in coo] + [[0]])
+        ku = max(0, offsets.max())
+        kl = max(0, -offsets.min())
+        kv = kl + ku
+        dtype = np.result_type(*[A.dtype for A in coo])
+        ab = np.zeros((len(coo), kv+kl+1, N), dtype=dtype)
+        for b, A in enumerate(coo):
+            ab[b, kv+A.row-A.col, A.col] = A.data
+        return kl, ku, ab
+
+
+class BatchedSolver(SolverBase):
+    """
+    Base class for batched solvers, acting on sequences of matrices with
+    identical sparsity patterns.  Single matrices are treated as batches of
+    one, so batched solvers can also be used as regular solvers.  When fewer
+    vectors than matrices are provided, the leading matrices of the batch are
+    used, allowing duplicate matrices to share a factorization.
+    """
+
+    batched = True
+
+    def __init__(self, matrix, solver=None):
+        # Promote single matrices to batches
+        self.single = sp.issparse(matrix)
+        if self.single:
+            matrices = [matrix]
+        else:
+            matrices = list(matrix)
+        self.factorize(matrices, solver)
+
+    def factorize(self, matrices, solver=None):
+        pass
+
+    def solve(self, vector):
+        if self.single:
+            return self.solve_batch(vector[None, :])[0]
+        else:
+            return self.solve_batch(vector)
+
+    def solve_many(self, vectors):
+        # Batches take stacked 2D right-hand sides with shape (batch, size, count)
+        if self.single:
+            return self.solve_many_batch(vectors[None, :, :])[0]
+        else:
+            return self.solve_many_batch(vectors)
+
+    def solve_batch(self, vectors):
+        pass
+
+    def solve_many_batch(self, vectors):
+        # Fallback looping over columns
+        return np.stack([self.solve_batch(vectors[..., i]) for i in range(vectors.shape[-1])], axis=-1)
+
 
 class DenseSolver(SolverBase):
     """Base class for dense solvers."""
@@ -53,6 +174,116 @@ class DenseSolver(SolverBase):
     banded = False
 
 
+class ReorderedSolver(SolverBase):
+    """
+    Base class for solvers applying a symmetric reverse Cuthill-McKee
+    reordering before factorizing with another matsolver, reducing the
+    bandwidth for banded solvers.  Batches share the reordering of their
+    first matrix, since batches have identical sparsity patterns.
+    """
+
+    matsolver = None
+
+    def __init__(self, matrix, solver=None):
+        single = sp.issparse(matrix)
+        matrices = [matrix] if single else list(matrix)
+        self.perm = perm = rcm_permutation(matrices[0])
+        if perm is not None:
+            logger.debug("RCM reordering reduced bandwidths from {} to {}".format(bandwidths(matrices[0]), bandwidths(matrices[0][perm][:, perm])))
+            matrices = [A.tocsr()[perm][:, perm] for A in matrices]
+        self.inner = self.matsolver(matrices[0] if single else matrices, solver)
+
+    def solve(self, vector):
+        perm = self.perm
+        if perm is None:
+            return self.inner.solve(vector)
+        x = self.inner.solve(vector[..., perm])
+        out = np.empty_like(x)
+        out[..., perm] = x
+        return out
+
+    def solve_many(self, vectors):
+        perm = self.perm
+        if perm is None:
+            return self.inner.solve_many(vectors)
+        x = self.inner.solve_many(vectors[..., perm, :])
+        out = np.empty_like(x)
+        out[..., perm, :] = x
+        return out
+
+
+@CachedFunction
+def reordered(matsolver):
+    """Build matsolver class applying a reverse Cuthill-McKee reordering before another matsolver."""
+    if not matsolver.reorderable:
+        raise ValueError("{} cannot be combined with a matrix reordering.".format(matsolver.__name__))
+    attrs = {'matsolver': matsolver,
+             'batched': matsolver.batched,
+             'sparse': getattr(matsolver, 'sparse', False),
+             'banded': getattr(matsolver, 'banded', False),
+             '__doc__': "{} with reverse Cuthill-McKee reordering.".format((matsolver.__doc__ or matsolver.__name__).strip().splitlines()[0].rstrip('.'))}
+    return type('Reordered'+matsolver.__name__, (ReorderedSolver,), attrs)
+
+
+def apply_reordering(matsolver, reordering):
+    """Apply a matrix reordering ('none' or 'rcm') to a matsolver class."""
+    reordering = str(reordering).lower()
+    if reordering == 'none':
+        return matsolver
+    elif reordering == 'rcm':
+        if not matsolver.reorderable:
+            logger.debug("Skipping RCM reordering for {}".format(matsolver.__name__))
+            return matsolver
+        return reordered(matsolver)
+    else:
+        raise ValueError("Unknown matrix reordering: {}".format(reordering))
+
+
+def autotune(candidates, matrices, solver=None, repeats=3):
+    """
+    Time factorization and a solve with each candidate matsolver on
+    representative matrices.
+
+    Parameters
+    ----------
+    candidates : list of matsolver classes
+        Matsolvers to time
+    matrices : list of sparse matrices
+        Representative matrices
+    solver : solver object, optional
+        Solver passed to the matsolvers
+    repeats : int, optional
+        Number of timing repeats, keeping the fastest (default: 3)
+
+    Returns
+    -------
+    timings : dict
+        Best times keyed by matsolver class, for candidates that could be
+        built and accurately solved the representative systems
+
+    """
+    rng = np.random.default_rng(0)
+    vectors = [rng.standard_normal(A.shape[0]).astype(A.dtype) for A in matrices]
+    timings = {}
+    for matsolver in candidates:
+        try:
+            best = np.inf
+            for i in range(repeats):
+                start = time.perf_counter()
+                solutions = [matsolver(A, solver).solve(b) for A, b in zip(matrices, vectors)]
+                best = min(best, time.perf_counter() - start)
+        except Exception as error:
+            # Skip candidates missing requirements or unsuited to the matrices
+            logger.debug("Autotuning skipped {}: {!r}".format(matsolver.__name__, error))
+            continue
+        if not all(np.allclose(A @ x, b) for A, x, b in zip(matrices, solutions, vectors)):
+            logger.debug("Autotuning skipped {}: inaccurate solution".format(matsolver.__name__))
+            continue
+        logger.debug("Autotuning timed {}: {:.3e} sec".format(matsolver.__name__, best))
+        timings[matsolver] = best
+    return timings
+
+
 @add_solver
 class UmfpackSpsolve(SparseSolver):
     """UMFPACK spsolve."""
@@ -75,6 +306,9 @@ class SuperluNaturalSpsolve(SparseSolver):
     def solve(self, vector):
         return spla.spsolve(self.matrix, vector, permc_spec='NATURAL', use_umfpack=False)
 
+    def solve_many(self, vectors):
+        return spla.spsolve(self.matrix, vectors, permc_spec='NATURAL', use_umfpack=False)
+
 
 @add_solver
 class SuperluColamdSpsolve(SparseSolver):
@@ -86,6 +320,9 @@ class SuperluColamdSpsolve(SparseSolver):
     def solve(self, vector):
         return spla.spsolve(self.matrix, vector, permc_spec='COLAMD', use_umfpack=False)
 
+    def solve_many(self, vectors):
+        return spla.spsolve(self.matrix, vectors, permc_spec='COLAMD', use_umfpack=False)
+
 
 @add_solver
 class UmfpackFactorized(SparseSolver):
@@ -109,6 +346,9 @@ class SuperluNaturalFactorized(SparseSolver):
     def solve(self, vector):
         return self.LU.solve(vector)
 
+    def solve_many(self, vectors):
+        return self.LU.solve(vectors)
+
 
 @add_solver
 class SuperluColamdFactorized(SparseSolver):
@@ -120,6 +360,9 @@ class SuperluColamdFactorized(SparseSolver):
     def solve(self, vector):
         return self.LU.solve(vector)
 
+    def solve_many(self, vectors):
+        return self.LU.solve(vectors)
+
 
 @add_solver
 class ScipyBanded(BandedSolver):
@@ -131,6 +374,221 @@ class ScipyBanded(BandedSolver):
     def solve(self, vector):
         return sla.solve_banded(self.lu, self.ab, vector, check_finite=False)
 
+    def solve_many(self, vectors):
+        return sla.solve_banded(self.lu, self.ab, vectors, check_finite=False)
+
+
+@add_solver
+class BatchedBandedLU(BatchedSolver, BandedSolver):
+    """
+    Batched banded LU solve with partial pivoting.
+    Each elimination step is vectorized over the batch, so the Python overhead
+    scales with the matrix size rather than the number of matrices.  The
+    factorization and solves still loop over the matrix columns in Python,
+    so this is only faster than LapackBanded for batches that are large
+    compared to the matrix size.
+    """
+
+    def factorize(self, matrices, solver=None):
+        B = len(matrices)
+        N = matrices[0].shape[0]
+        # Stack in LAPACK band storage
+        self.kl, self.ku, ab = self.sparse_to_lapack_banded(matrices)
+        kl, kv = self.kl, self.kl + self.ku
+        self.kv = kv
+        # Factorize in place
+        batch = np.arange(B)[:, None]
+        piv = np.zeros((B, N), dtype=int)
+        for j in range(N):
+            km = min(kl, N-1-j)
+            ju = min(j+kv, N-1)
+            # Find pivots and record global row indices
+            jp = np.argmax(np.abs(ab[:, kv:kv+km+1, j]), axis=1)
+            piv[:, j] = j + jp
+            # Swap rows j and piv[j] across the upper band
+            cols = np.arange(j, ju+1)[None, :]
+            row_j = kv + j - cols
+            row_p = kv + j + jp[:, None] - cols
+            temp = ab[batch, row_j, cols]
+            ab[batch, row_j, cols] = ab[batch, row_p, cols]
+            ab[batch, row_p, cols] = temp
+            if km > 0:
+                # Compute multipliers
+                ab[:, kv+1:kv+km+1, j] /= ab[:, kv:kv+1, j]
+                # Rank-one update of trailing band
+                if ju > j:
+                    rows = np.arange(j+1, j+km+1)[:, None]
+                    cols = np.arange(j+1, ju+1)[None, :]
+                    l = ab[:, kv+1:kv+km+1, j]
+                    u = ab[:, kv+j-cols[0], cols[0]]
+                    ab[:, kv+rows-cols, cols] -= l[:, :, None] * u[:, None, :]
+        # Check for zero pivots
+        zero_pivots = np.argwhere(ab[:, kv, :] == 0)
+        if zero_pivots.size:
+            b, j = zero_pivots[0]
+            raise np.linalg.LinAlgError("Singular matrix {} in batch: zero pivot in row {}.".format(b, j))
+        self.ab = ab
+        self.piv = piv
+
+    def solve_batch(self, vectors):
+        kl, kv = self.kl, self.kv
+        # Use leading factorizations for partial batches
+        B = len(vectors)
+        ab = self.ab[:B]
+        piv = self.piv[:B]
+        N = ab.shape[2]
+        batch = np.arange(B)
+        x = np.array(vectors, dtype=np.result_type(ab.dtype, vectors.dtype))
+        # Forward substitution with row interchanges
+        for j in range(N):
+            p = piv[:, j]
+            temp = x[batch, p]
+            x[batch, p] = x[:, j]
+            x[:, j] = temp
+            km = min(kl, N-1-j)
+            if km > 0:
+                x[:, j+1:j+km+1] -= ab[:, kv+1:kv+km+1, j] * x[:, j:j+1]
+        # Backward substitution
+        for j in range(N-1, -1, -1):
+            x[:, j] /= ab[:, kv, j]
+            i0 = max(0, j-kv)
+            if i0 < j:
+                x[:, i0:j] -= ab[:, kv+i0-j:kv, j] * x[:, j:j+1]
+        return x
+
+
+class LapackBandedMixin:
+    """LAPACK gbtrf/gbtrs factorization and solves for stacked band storage."""
+
+    def lapack_factorize(self, ab):
+        """Factorize stacked band matrices in place, keeping the pivots."""
+        kl, ku = self.kl, self.ku
+        gbtrf, self.gbtrs = sla.get_lapack_funcs(('gbtrf', 'gbtrs'), (ab,))
+        self.lu = []
+        self.piv = []
+        for ab_b in ab:
+            lu, piv, info = gbtrf(ab_b, kl, ku, overwrite_ab=True)
+            if info > 0:
+                raise sla.LinAlgError("Singular matrix: zero pivot in row {}.".format(info-1))
+            elif info < 0:
+                raise ValueError("Illegal value in argument {} of gbtrf.".format(-info))
+            self.lu.append(lu)
+            self.piv.append(piv)
+
+    def lapack_solve(self, index, vector):
+        """Solve using factors from a single matrix of the batch."""
+        lu, piv = self.lu[index], self.piv[index]
+        # Solve real and imaginary parts separately with real factors
+        if np.iscomplexobj(vector) and not np.iscomplexobj(lu):
+            return self.lapack_solve(index, vector.real) + 1j*self.lapack_solve(index, vector.imag)
+        x, info = self.gbtrs(lu, self.kl, self.ku, vector, piv)
+        if info < 0:
+            raise ValueError("Illegal value in argument {} of gbtrs.".format(-info))
+        return x
+
+
+@add_solver
+class LapackBanded(LapackBandedMixin, BandedSolver):
+    """LAPACK banded LU factorized solve."""
+
+    def __init__(self, matrix, solver=None):
+        self.kl, self.ku, ab = self.sparse_to_lapack_banded([matrix])
+        self.lapack_factorize(ab)
+
+    def solve(self, vector):
+        return self.lapack_solve(0, vector)
+
+    def solve_many(self, vectors):
+        return self.lapack_solve(0, vectors)
+
+
+@add_solver
+class BatchedLapackBanded(LapackBandedMixin, BatchedSolver, BandedSolver):
+    """
+    Batched LAPACK banded LU factorized solve.
+    Matrices are stacked at their joint bandwidths and factorized once.
+    LAPACK has no batched banded routines, so this still makes a gbtrf call
+    per matrix when factorizing and a gbtrs call per matrix when solving.
+    Only the band storage and the batched interface are shared.
+    """
+
+    def factorize(self, matrices, solver=None):
+        self.kl, self.ku, ab = self.sparse_to_lapack_banded(matrices)
+        self.lapack_factorize(ab)
+
+    def solve_batch(self, vectors):
+        # Use leading factorizations for partial batches
+        return np.array([self.lapack_solve(b, v) for b, v in enumerate(vectors)])
+
+    def solve_many_batch(self, vectors):
+        return self.solve_batch(vectors)
+
+
+class KrylovSolver(SparseSolver):
+    """
+    Base class for preconditioned Krylov solvers.  The preconditioner is
+    built once per matrix and reused across solves, and each solve is warm
+    started from the previous solution.
+    """
+
+    method = None
+
+    def __init__(self, matrix, solver=None):
+        self.matrix = matrix.tocsr(copy=True)
+        self.preconditioner = self.build_preconditioner(self.matrix, KRYLOV_PRECONDITIONER)
+        self.x0 = None
+
+    @staticmethod
+    def build_preconditioner(matrix, kind):
+        """Build preconditioner ('ilu', 'banded', or 'none') as a linear operator."""
+        if kind == 'none':
+            return None
+        elif kind == 'ilu':
+            # Incomplete LU factorization
+            inner = spla.spilu(matrix.tocsc(), drop_tol=ILU_DROP_TOL, fill_factor=ILU_FILL_FACTOR)
+        elif kind == 'banded':
+            # LU factorization of the matrix truncated to KRYLOV_BANDWIDTH
+            A = matrix.tocoo()
+            band = np.abs(A.col.astype(int) - A.row.astype(int)) <= KRYLOV_BANDWIDTH
+            band_matrix = sp.coo_matrix((A.data[band], (A.row[band], A.col[band])), shape=A.shape)
+            inner = LapackBanded(band_matrix)
+        else:
+            raise ValueError("Unknown Krylov preconditioner: {}".format(kind))
+        def matvec(vector):
+            # Apply real factors separately to real and imaginary parts
+            if np.iscomplexobj(vector) and not np.iscomplexobj(matrix):
+                return inner.solve(vector.real) + 1j*inner.solve(vector.imag)
+            return inner.solve(vector)
+        return spla.LinearOperator(matrix.shape, matvec=matvec, dtype=matrix.dtype)
+
+    def solve(self, vector):
+        # Warm start from the previous solution
+        x0 = self.x0
+        if x0 is not None and not np.can_cast(x0.dtype, np.result_type(self.matrix.dtype, vector.dtype)):
+            x0 = None
+        kw = {KRYLOV_TOL_KEYWORD: KRYLOV_TOLERANCE}
+        x, info = self.method(self.matrix, vector, x0=x0, M=self.preconditioner, atol=0, maxiter=KRYLOV_MAXITER, **kw)
+        if info > 0:
+            logger.warning("{} did not converge to tolerance {} in {} iterations.".format(type(self).__name__, KRYLOV_TOLERANCE, info))
+        elif info < 0:
+            raise ValueError("Illegal input or breakdown in {}.".format(type(self).__name__))
+        self.x0 = x
+        return x
+
+
+@add_solver
+class Gmres(KrylovSolver):
+    """Preconditioned GMRES solve."""
+
+    method = staticmethod(spla.gmres)
+
+
+@add_solver
+class Bicgstab(KrylovSolver):
+    """Preconditioned BiCGStab solve."""
+
+    method = staticmethod(spla.bicgstab)
+
 
 @add_solver
 class SPQR_solve(SparseSolver):
@@ -138,10 +596,14 @@ class SPQR_solve(SparseSolver):
 
     def __init__(self, matrix, solver=None):
         import sparseqr
+        self.sparseqr = sparseqr
         self.matrix = matrix.copy()
 
     def solve(self, vector):
-        return sparseqr.solve(self.matrix, vector)
+        return self.sparseqr.solve(self.matrix, vector)
+
+    def solve_many(self, vectors):
+        return self.sparseqr.solve(self.matrix, vectors)
 
 
 @add_solver
@@ -167,6 +629,9 @@ class SparseInverse(SparseSolver):
     def solve(self, vector):
         return self.matrix_inverse @ vector
 
+    def solve_many(self, vectors):
+        return self.matrix_inverse @ vectors
+
 
 @add_solver
 class DenseInverse(DenseSolver):
@@ -178,33 +643,59 @@ class DenseInverse(DenseSolver):
     def solve(self, vector):
         return self.matrix_inverse @ vector
 
+    def solve_many(self, vectors):
+        return self.matrix_inverse @ vectors
+
 
 @add_solver
-class BlockInverse(BandedSolver):
-    """Block inversion solve."""
+class BlockInverse(BatchedSolver, BandedSolver):
+    """
+    Block inversion solve.
+    Inverse blocks are stored densely with shape (batch, nblocks, b, b), so
+    all pencils of a batch are inverted and solved with single batched calls.
+    Not reorderable, since this relies on contiguous diagonal blocks.
+    """
+
+    reorderable = False
 
-    def __init__(self, matrix, solver):
-        from dedalus.tools.sparse import same_dense_block_diag
+    def factorize(self, matrices, solver=None):
         # Check separability
-        if solver.domain.bases[-1].coupled:
+        if solver is None or solver.domain.bases[-1].coupled:
             raise ValueError("Block solver requires uncoupled problems.")
-        block_size = b = len(solver.problem.variables)
-        # Produce inverse
-        if block_size == 1:
+        b = len(solver.problem.variables)
+        N = matrices[0].shape[0]
+        if N % b:
+            raise ValueError("Matrix size is not a multiple of the block size.")
+        # Gather blocks from all matrices
+        coo = [matrix.tocoo() for matrix in matrices]
+        batch = np.concatenate([np.full(A.nnz, i) for i, A in enumerate(coo)])
+        rows = np.concatenate([A.row for A in coo])
+        cols = np.concatenate([A.col for A in coo])
+        if np.any(rows // b != cols // b):
+            raise ValueError("Block solver requires block diagonal matrices.")
+        dtype = np.result_type(*[A.dtype for A in coo])
+        blocks = np.zeros((len(coo), N//b, b, b), dtype=dtype)
+        np.add.at(blocks, (batch, rows//b, rows%b, cols%b), np.concatenate([A.data for A in coo]))
+        # Compute block inverses
+        if b == 1:
             # Special-case diagonal matrices
-            self.matrix_inv_diagonal = 1 / matrix.todia().data[0]
-            self.solve = self._solve_diag
+            self.inv_diagonal = 1 / blocks[:, :, 0, 0]
         else:
-            # Covert to BSR to extract blocks
-            bsr_matrix = matrix.tobsr(blocksize=(b, b))
-            # Compute block inverses
-            inv_blocks = np.linalg.inv(bsr_matrix.data)
-            self.matrix_inverse = same_dense_block_diag(list(inv_blocks), format='csr')
-            self.solve = self._solve_block
-
-    def _solve_block(self, vector):
-        return self.matrix_inverse @ vector
-
-    def _solve_diag(self, vector):
-        return self.matrix_inv_diagonal * vector
-
+            self.inv_diagonal = None
+            self.inv_blocks = np.linalg.inv(blocks)
+        self.block_size = b
+
+    def solve_batch(self, vectors):
+        # Use leading inverses for partial batches
+        B = len(vectors)
+        if self.inv_diagonal is not None:
+            return self.inv_diagonal[:B] * vectors
+        v = vectors.reshape(B, -1, self.block_size, 1)
+        return np.matmul(self.inv_blocks[:B], v).reshape(B, -1)
+
+    def solve_many_batch(self, vectors):
+        B, N, K = vectors.shape
+        if self.inv_diagonal is not None:
+            return self.inv_diagonal[:B, :, None] * vectors
+        v = vectors.reshape(B, -1, self.block_size, K)
+        return np.matmul(self.inv_blocks[:B], v).reshape(B, N, K)
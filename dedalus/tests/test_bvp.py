@@ -5,7 +5,10 @@ Test 2D BVP with various bases and dtypes.
 import pytest
 import numpy as np
 import functools
+import pathlib
 from dedalus import public as de
+from dedalus.core import solvers
+from dedalus.core import pencil
 
 
 def bench_wrapper(test):
@@ -48,6 +51,67 @@ def test_poisson_2d_periodic(benchmark, x_basis_class, y_basis_class, Nx, Ny, dt
     assert np.allclose(u['g'], u_true)
 
 
+@pytest.mark.parametrize('dtype', [np.float64, np.complex128])
+def test_poisson_2d_periodic_builtin_condition(dtype):
+    # Bases and domain
+    x_basis = de.Fourier('x', 8, interval=(0, 2*np.pi))
+    y_basis = de.Fourier('y', 16, interval=(0, 2*np.pi))
+    domain = de.Domain([x_basis, y_basis], grid_dtype=dtype)
+    # Forcing
+    F = domain.new_field(name='F')
+    x, y = domain.all_grids()
+    F['g'] = -2 * np.sin(x) * np.sin(y)
+    # Problem with conditions calling Python builtins
+    problem = de.LBVP(domain, variables=['u'])
+    problem.parameters['F'] = F
+    problem.add_equation("dx(dx(u)) + dy(dy(u)) = F", condition="max(nx, ny) > 0")
+    problem.add_equation("u = 0", condition="max(nx, ny) == 0")
+    # Solver
+    solver = problem.build_solver()
+    solver.solve()
+    # Check solution
+    u_true = np.sin(x) * np.sin(y)
+    u = solver.state['u']
+    assert np.allclose(u['g'], u_true)
+
+
+def test_poisson_2d_periodic_autotune(tmp_path, monkeypatch):
+    cache_file = tmp_path / 'autotune.json'
+    monkeypatch.setattr(solvers, 'AUTOTUNE_CACHE_FILE', str(cache_file))
+    def build_and_solve():
+        # Bases and domain
+        x_basis = de.Fourier('x', 8, interval=(0, 2*np.pi))
+        y_basis = de.Fourier('y', 16, interval=(0, 2*np.pi))
+        domain = de.Domain([x_basis, y_basis], grid_dtype=np.float64)
+        # Forcing
+        F = domain.new_field(name='F')
+        x, y = domain.all_grids()
+        F['g'] = -2 * np.sin(x) * np.sin(y)
+        # Problem
+        problem = de.LBVP(domain, variables=['u'])
+        problem.parameters['F'] = F
+        problem.add_equation("dx(dx(u)) + dy(dy(u)) = F", condition="(nx != 0) or (ny != 0)")
+        problem.add_equation("u = 0", condition="(nx == 0) and (ny == 0)")
+        # Solver
+        solver = problem.build_solver(matsolver='auto')
+        solver.solve()
+        # Check solution
+        u_true = np.sin(x) * np.sin(y)
+        u = solver.state['u']
+        assert np.allclose(u['g'], u_true)
+        return solver.matsolver
+    # First build times the candidates and records the choice
+    candidates = [solvers.lookup_matsolver(name) for name in solvers.AUTOTUNE_CANDIDATES]
+    matsolver = build_and_solve()
+    assert matsolver in candidates
+    assert cache_file.is_file()
+    # Second build reuses the recorded choice without timing
+    def fail(*args, **kw):
+        raise AssertionError("Autotuning repeated despite cached choice")
+    monkeypatch.setattr(solvers, 'autotune', fail)
+    assert build_and_solve() is matsolver
+
+
 @pytest.mark.parametrize('dtype', [np.float64, np.complex128])
 @pytest.mark.parametrize('Ny', [64])
 @pytest.mark.parametrize('Nx', [8])
@@ -144,6 +208,130 @@ def test_poisson_2d_nonperiodic(benchmark, x_basis_class, y_basis_class, Nx, Ny,
     assert np.allclose(u['g'], u_true)
 
 
+@pytest.mark.parametrize('dtype', [np.float64, np.complex128])
+def test_poisson_2d_nonperiodic_matrix_cache(tmp_path, monkeypatch, dtype):
+    monkeypatch.setattr(pencil, 'MATRIX_CACHE_DIR', str(tmp_path))
+    def build_problem(a):
+        # Bases and domain
+        x_basis = de.Fourier('x', 8, interval=(0, 2*np.pi))
+        y_basis = de.Chebyshev('y', 32, interval=(0, 2*np.pi))
+        domain = de.Domain([x_basis, y_basis], grid_dtype=dtype)
+        # NCC
+        G = domain.new_field(name='G')
+        G.meta['x']['constant'] = True
+        x, y = domain.all_grids()
+        G['g'] = 1 + np.cos(y) / 4
+        # Problem
+        problem = de.LBVP(domain, variables=['u','uy'])
+        problem.parameters['G'] = G
+        problem.parameters['a'] = a
+        problem.add_equation("uy - dy(u) = 0")
+        problem.add_equation("dx(dx(u)) + dy(uy) - a*G*u = 0")
+        problem.add_bc("left(u) - right(u) = 0")
+        problem.add_bc("left(uy) - right(uy) = 0", condition="nx != 0")
+        problem.add_bc("left(u) = 0", condition="nx == 0")
+        return problem
+    def cache_path(problem):
+        pencils = pencil.build_pencils(problem.domain)
+        return pencil.matrix_cache_path(pencils, problem, ['L'])
+    # Build and save matrices
+    problem = build_problem(1)
+    path = cache_path(problem)
+    assert path is not None
+    solver = problem.build_solver()
+    assert pathlib.Path(path).is_file()
+    # Rebuild from cache without assembling
+    def fail(*args, **kw):
+        raise AssertionError("Pencil matrices rebuilt despite cache")
+    with monkeypatch.context() as m:
+        m.setattr(pencil, 'select_equations', fail)
+        cached_solver = build_problem(1).build_solver()
+    for p, cp in zip(solver.pencils, cached_solver.pencils):
+        for attr in pencil.matrix_attributes(['L']):
+            A = getattr(p, attr)
+            B = getattr(cp, attr)
+            assert A.shape == B.shape
+            assert np.allclose(A.toarray(), B.toarray())
+    # Corrupt cache files are rebuilt
+    pathlib.Path(path).write_bytes(b'corrupt')
+    rebuilt_solver = build_problem(1).build_solver()
+    for p, rp in zip(solver.pencils, rebuilt_solver.pencils):
+        assert np.allclose(p.L_exp.toarray(), rp.L_exp.toarray())
+    # Changing a parameter value changes the key
+    assert cache_path(build_problem(2)) != path
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.complex128])
+def test_poisson_2d_nonperiodic_parameter_pieces(dtype):
+    # Bases and domain
+    x_basis = de.Fourier('x', 8, interval=(0, 2*np.pi))
+    y_basis = de.Chebyshev('y', 32, interval=(0, 2*np.pi))
+    domain = de.Domain([x_basis, y_basis], grid_dtype=dtype)
+    # NCC
+    G = domain.new_field(name='G')
+    G.meta['x']['constant'] = True
+    x, y = domain.all_grids()
+    G['g'] = 1 + np.cos(y) / 4
+    # Problem
+    problem = de.LBVP(domain, variables=['u','uy'])
+    problem.parameters['G'] = G
+    problem.parameters['a'] = 2
+    problem.parameters['b'] = 1e-13
+    problem.add_equation("uy - dy(u) = 0")
+    problem.add_equation("dx(dx(u)) + dy(uy) - a*G*u - b*u = 0")
+    problem.add_bc("left(u) - right(u) = 0")
+    problem.add_bc("left(uy) - right(uy) = 0", condition="nx != 0")
+    problem.add_bc("left(u) = 0", condition="nx == 0")
+    # Combined pieces match directly built matrices, including truncation
+    pieces = pencil.ParameterPieces(problem, ['L'])
+    piece_pencils = pencil.build_pencils(domain)
+    for a, b in [(2, 1e-13), (3, 1)]:
+        problem.namespace['a'].value = a
+        problem.namespace['b'].value = b
+        pieces.build_matrices(piece_pencils)
+        pencils = pencil.build_pencils(domain)
+        pencil.build_matrices(pencils, problem, ['L'], cache=False)
+        for p, pp in zip(pencils, piece_pencils):
+            for attr in ['L', 'L_exp']:
+                A = getattr(p, attr)
+                B = getattr(pp, attr)
+                assert A.shape == B.shape
+                assert np.allclose(A.toarray(), B.toarray(), rtol=1e-10, atol=1e-15)
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.complex128])
+def test_poisson_2d_nonperiodic_build_processes(monkeypatch, dtype):
+    # Bases and domain
+    x_basis = de.Fourier('x', 8, interval=(0, 2*np.pi))
+    y_basis = de.Chebyshev('y', 32, interval=(0, 2*np.pi))
+    domain = de.Domain([x_basis, y_basis], grid_dtype=dtype)
+    # NCC
+    G = domain.new_field(name='G')
+    G.meta['x']['constant'] = True
+    x, y = domain.all_grids()
+    G['g'] = 1 + np.cos(y) / 4
+    # Problem
+    problem = de.LBVP(domain, variables=['u','uy'])
+    problem.parameters['G'] = G
+    problem.add_equation("uy - dy(u) = 0")
+    problem.add_equation("dx(dx(u)) + dy(uy) - G*u = 0")
+    problem.add_bc("left(u) - right(u) = 0")
+    problem.add_bc("left(uy) - right(uy) = 0", condition="nx != 0")
+    problem.add_bc("left(u) = 0", condition="nx == 0")
+    # Build serially and on forked processes
+    pencils = pencil.build_pencils(domain)
+    pencil.build_matrices(pencils, problem, ['L'], cache=False)
+    monkeypatch.setattr(pencil, 'BUILD_PROCESSES', 2)
+    pool_pencils = pencil.build_pencils(domain)
+    pencil.build_matrices(pool_pencils, problem, ['L'], cache=False)
+    for p, pp in zip(pencils, pool_pencils):
+        for attr in pencil.matrix_attributes(['L']):
+            A = getattr(p, attr)
+            B = getattr(pp, attr)
+            assert A.shape == B.shape
+            assert np.allclose(A.toarray(), B.toarray())
+
+
 def DoubleLaguerre(name, N, center=0.0, stretch=1.0, dealias=1):
     b0 = de.Laguerre('b0', int(N//2), edge=center, stretch=-stretch, dealias=dealias)
     b1 = de.Laguerre('b1', int(N//2), edge=center, stretch=stretch, dealias=dealias)
@@ -322,3 +510,28 @@ def test_double_exponential_forced(benchmark, x_basis_class, Nx, dtype):
     u = solver.state['u']
     assert np.allclose(u['g'], u_true)
 
+
+@pytest.mark.parametrize('dtype', [np.float64, np.complex128])
+@pytest.mark.parametrize('Nx', [32])
+@pytest.mark.parametrize('x_basis_class', [de.Chebyshev])
+@bench_wrapper
+def test_exponential_rebuild_parameter(benchmark, x_basis_class, Nx, dtype):
+    # Bases and domain
+    x_basis = x_basis_class('x', Nx, interval=(0, 1))
+    domain = de.Domain([x_basis], grid_dtype=dtype)
+    # Problem
+    problem = de.LBVP(domain, variables=['u'])
+    problem.parameters['a'] = 1
+    problem.add_equation("dx(u) + a*u = 0")
+    problem.add_bc("left(u) = 1")
+    # Solver
+    solver = problem.build_solver()
+    solver.solve()
+    # Change parameter and rebuild
+    x = domain.grid(0)
+    for a in [2, 0.5]:
+        problem.namespace['a'].value = a
+        solver.solve(rebuild_coeffs=True)
+        u_true = np.exp(-a*x)
+        u = solver.state['u']
+        assert np.allclose(u['g'], u_true)
@@ -6,6 +6,9 @@ import pytest
 import numpy as np
 import functools
 from dedalus import public as de
+from dedalus.core import solvers
+from dedalus.core import timesteppers
+from dedalus.extras import flow_tools
 
 
 def bench_wrapper(test):
@@ -148,3 +151,223 @@ def test_heat_ode_1d_nonperiodic(benchmark, x_basis_class, Nx, timestepper, dtyp
     a_match = np.allclose(solver.state['a']['g'], amp)
     assert (u_match and a_match)
 
+
+@pytest.mark.parametrize('dtype', [np.float64])
+@pytest.mark.parametrize('timestepper', [ts for ts in de.timesteppers.schemes.values() if getattr(ts, 'A_hat', None) is not None])
+@pytest.mark.parametrize('Nx', [32])
+@pytest.mark.parametrize('x_basis_class', [de.Fourier])
+@bench_wrapper
+def test_heat_1d_periodic_adaptive(benchmark, x_basis_class, Nx, timestepper, dtype):
+    # Bases and domain
+    x_basis = x_basis_class('x', Nx, interval=(0, 2*np.pi))
+    domain = de.Domain([x_basis], grid_dtype=dtype)
+    # Forcing
+    F = domain.new_field(name='F')
+    F.meta['x']['parity'] = -1
+    x = domain.grid(0)
+    F['g'] = -np.sin(x)
+    # Problem
+    problem = de.IVP(domain, variables=['u'])
+    problem.meta['u']['x']['parity'] = -1
+    problem.parameters['F'] = F
+    problem.add_equation("-dt(u) + dx(dx(u)) = F")
+    # Solver
+    solver = problem.build_solver(timestepper)
+    solver.stop_sim_time = 1
+    dt = 1e-5
+    while solver.proceed:
+        dt = solver.step_adaptive(min(dt, solver.stop_sim_time - solver.sim_time), atol=1e-8, rtol=1e-8)
+    # Check solution
+    amp = 1 - np.exp(-solver.sim_time)
+    u_true = amp * np.sin(x)
+    u = solver.state['u']
+    assert np.allclose(u['g'], u_true)
+
+
+@pytest.mark.parametrize('timestepper', [ts for ts in de.timesteppers.schemes.values() if getattr(ts, 'A_hat', None) is not None])
+def test_heat_1d_periodic_adaptive_rejection(timestepper):
+    # Bases and domain
+    x_basis = de.Fourier('x', 32, interval=(0, 2*np.pi))
+    domain = de.Domain([x_basis], grid_dtype=np.float64)
+    # Forcing
+    F = domain.new_field(name='F')
+    x = domain.grid(0)
+    F['g'] = -np.sin(x)
+    # Problem
+    problem = de.IVP(domain, variables=['u'])
+    problem.parameters['F'] = F
+    problem.add_equation("-dt(u) + dx(dx(u)) = F")
+    # Solver
+    solver = problem.build_solver(timestepper)
+    # Oversized timestep is rejected and retried
+    solver.step_adaptive(1., atol=1e-8, rtol=1e-8)
+    assert solver.dt < 1
+    assert solver.iteration == 1
+    assert np.isclose(solver.sim_time, solver.dt)
+    amp = 1 - np.exp(-solver.sim_time)
+    u = solver.state['u']
+    assert np.allclose(u['g'], amp * np.sin(x), atol=1e-6)
+    # Limits on retries raise and leave the state in place
+    u_prev = np.copy(u['g'])
+    with pytest.raises(ValueError):
+        solver.step_adaptive(1., atol=1e-8, rtol=1e-8, max_rejections=0)
+    with pytest.raises(ValueError):
+        solver.step_adaptive(1., atol=1e-8, rtol=1e-8, min_dt=0.5)
+    assert solver.iteration == 1
+    assert np.allclose(solver.state['u']['g'], u_prev)
+
+
+@pytest.mark.parametrize('timestepper', [ts for ts in de.timesteppers.schemes.values() if getattr(ts, 'A_hat', None) is None])
+def test_heat_1d_periodic_adaptive_unsupported(timestepper):
+    # Bases and domain
+    x_basis = de.Fourier('x', 16, interval=(0, 2*np.pi))
+    domain = de.Domain([x_basis], grid_dtype=np.float64)
+    # Problem
+    problem = de.IVP(domain, variables=['u'])
+    problem.add_equation("-dt(u) + dx(dx(u)) = 0")
+    # Solver
+    solver = problem.build_solver(timestepper)
+    with pytest.raises(ValueError):
+        solver.step_adaptive(1e-3)
+
+
+def test_cfl_ladder():
+    # Bases and domain
+    x_basis = de.Fourier('x', 32, interval=(0, 2*np.pi))
+    domain = de.Domain([x_basis], grid_dtype=np.float64)
+    # Problem
+    problem = de.IVP(domain, variables=['u'])
+    problem.add_equation("-dt(u) + dx(dx(u)) = 0")
+    # Solver
+    solver = problem.build_solver(de.timesteppers.SBDF2)
+    x = domain.grid(0)
+    u = solver.state['u']
+    u['g'] = 10 * np.sin(x)
+    # CFL with geometric ladder anchored at max_dt
+    max_dt = 0.05
+    ratio = 2
+    CFL = flow_tools.CFL(solver, initial_dt=1e-3, max_dt=max_dt, max_change=3, ladder_ratio=ratio)
+    CFL.add_velocity('u', 0)
+    def rung(dt):
+        return np.log(dt / max_dt) / np.log(ratio)
+    # Snapping rounds down onto the ladder
+    for dt in np.geomspace(1e-4, 1, 50):
+        snapped = CFL.snap_to_ladder(dt)
+        assert snapped <= dt * (1 + 1e-9)
+        assert snapped > dt / ratio
+        assert np.isclose(rung(snapped), np.round(rung(snapped)))
+    # Computed timesteps stay on the ladder and below max_dt
+    for i in range(20):
+        dt = CFL.compute_dt()
+        if i > 1:
+            assert dt <= max_dt
+            assert np.isclose(rung(dt), np.round(rung(dt)))
+        solver.step(dt)
+
+
+def test_LHS_cache():
+    builds = []
+    def build(key):
+        builds.append(key)
+        return object()
+    cache = timesteppers.LHSCache(2)
+    # Repeated keys reuse entries
+    a = cache.get(1, build, 1)
+    assert cache.get(1, build, 1) is a
+    b = cache.get(2, build, 2)
+    assert builds == [1, 2]
+    # Least recently used entry is evicted
+    assert cache.get(1, build, 1) is a
+    cache.get(3, build, 3)
+    assert list(cache.entries) == [1, 3]
+    assert cache.get(1, build, 1) is a
+    assert cache.get(2, build, 2) is not b
+    assert builds == [1, 2, 3, 2]
+
+
+@pytest.mark.parametrize('timestepper', [de.timesteppers.SBDF1, de.timesteppers.RK222])
+def test_heat_1d_periodic_LHS_cache(monkeypatch, timestepper):
+    # Count LHS factorizations
+    builds = []
+    build_LHS_solvers = timesteppers.build_LHS_solvers
+    def counting_build(solver, a, b):
+        builds.append((a, b))
+        return build_LHS_solvers(solver, a, b)
+    monkeypatch.setattr(timesteppers, 'build_LHS_solvers', counting_build)
+    # Bases and domain
+    x_basis = de.Fourier('x', 32, interval=(0, 2*np.pi))
+    domain = de.Domain([x_basis], grid_dtype=np.float64)
+    # Forcing
+    F = domain.new_field(name='F')
+    x = domain.grid(0)
+    F['g'] = -np.sin(x)
+    # Problem
+    problem = de.IVP(domain, variables=['u'])
+    problem.parameters['F'] = F
+    problem.add_equation("-dt(u) + dx(dx(u)) = F")
+    # Solver caching two timesteps
+    solver = problem.build_solver(timestepper, LHS_cache_size=2)
+    for dt in [1e-3, 2e-3, 1e-3, 2e-3]:
+        solver.step(dt)
+    n_builds = len(builds)
+    # Alternating timesteps reuse the cached factorizations
+    for dt in [1e-3, 2e-3, 1e-3, 2e-3]:
+        solver.step(dt)
+    assert len(builds) == n_builds
+    # Check solution to first-order accuracy
+    amp = 1 - np.exp(-solver.sim_time)
+    u = solver.state['u']
+    assert np.allclose(u['g'], amp * np.sin(x), atol=1e-4)
+
+
+@pytest.mark.parametrize('timestepper', [de.timesteppers.SBDF2, de.timesteppers.RK222])
+def test_heat_1d_periodic_batched_default(monkeypatch, timestepper):
+    monkeypatch.setattr(solvers, 'BATCHED_FACTORIZER', 'BlockInverse')
+    # Bases and domain
+    x_basis = de.Fourier('x', 32, interval=(0, 2*np.pi))
+    domain = de.Domain([x_basis], grid_dtype=np.float64)
+    # Forcing
+    F = domain.new_field(name='F')
+    x = domain.grid(0)
+    F['g'] = -np.sin(x)
+    # Problem
+    problem = de.IVP(domain, variables=['u'])
+    problem.parameters['F'] = F
+    problem.add_equation("-dt(u) + dx(dx(u)) = F")
+    # Uncoupled pencils default to the batched factorizer
+    solver = problem.build_solver(timestepper)
+    assert solver.matsolver is de.matsolvers.BlockInverse
+    dt = 1e-5
+    for i in range(10):
+        solver.step(dt)
+    # Check solution
+    amp = 1 - np.exp(-solver.sim_time)
+    u = solver.state['u']
+    assert np.allclose(u['g'], amp * np.sin(x))
+
+
+@pytest.mark.parametrize('x_basis_class', [de.Fourier, de.Chebyshev])
+def test_pencil_matrices_share_block_data(x_basis_class):
+    # Bases and domain
+    x_basis = x_basis_class('x', 16, interval=(0, 2*np.pi))
+    domain = de.Domain([x_basis], grid_dtype=np.float64)
+    # Problem
+    problem = de.IVP(domain, variables=['u', 'ux'])
+    problem.add_equation("-dt(u) + dx(ux) = 0")
+    problem.add_equation("ux - dx(u) = 0")
+    if x_basis.coupled:
+        problem.add_bc("left(u) = 0")
+        problem.add_bc("right(u) = 0")
+    # Solver
+    solver = problem.build_solver(de.timesteppers.SBDF1)
+    # Pencil matrices remain available and share entries with the block matrices
+    for name in ['M', 'L', 'pre_left', 'pre_right']:
+        block = solver.block_matrices[name]
+        i0 = j0 = 0
+        for p in solver.pencils:
+            matrix = getattr(p, name)
+            i1, j1 = i0 + matrix.shape[0], j0 + matrix.shape[1]
+            assert np.allclose(matrix.toarray(), block[i0:i1, j0:j1].toarray())
+            if matrix.nnz:
+                assert np.shares_memory(matrix.data, block.data)
+            i0, j0 = i1, j1
@@ -127,6 +127,67 @@ def test_matsolver_solve_bench(benchmark, solver, matsolver):
     assert np.allclose(u['g'], u_true)
 
 
+@pytest.mark.parametrize('matsolver', [de.matsolvers.ScipyBanded, de.matsolvers.BatchedBandedLU, de.matsolvers.SuperluNaturalFactorized])
+@pytest.mark.parametrize('solver', solvers, ids=ids)
+def test_matsolver_reordered(solver, matsolver):
+    # Setup reordered matsolver
+    solver.matsolver = de.matsolvers.reordered(matsolver)
+    solver._build_pencil_matsolvers()
+    solver.solve()
+    # Check solution
+    x, y = solver.domain.all_grids()
+    u_true = np.sin(x) * np.sin(y)
+    u = solver.state['u']
+    assert np.allclose(u['g'], u_true)
+
+
+def test_matsolver_reordered_block_inverse():
+    # Block solvers keep their ordering
+    assert de.matsolvers.apply_reordering(de.matsolvers.BlockInverse, 'rcm') is de.matsolvers.BlockInverse
+    with pytest.raises(ValueError):
+        de.matsolvers.reordered(de.matsolvers.BlockInverse)
+
+
+@pytest.mark.parametrize('matsolver', de.matsolvers.matsolvers.values())
+@pytest.mark.parametrize('solver', solvers, ids=ids)
+def test_matsolver_solve_many(solver, matsolver):
+    # Setup matsolver for a single pencil
+    A = solver.pencils[-1].L_exp
+    try:
+        pencil_matsolver = matsolver(A, solver)
+    except ModuleNotFoundError:
+        pytest.skip("Matsolver requirements not present.")
+    except ValueError:
+        pytest.xfail("Invalid input for matsolver.")
+    # Solve for multiple right-hand sides
+    rng = np.random.default_rng(0)
+    b = rng.standard_normal((A.shape[0], 3)).astype(A.dtype)
+    x = pencil_matsolver.solve_many(b)
+    assert np.allclose(A @ x, b)
+
+
+@pytest.mark.parametrize('matsolver', de.matsolvers.matsolvers.values())
+@pytest.mark.parametrize('solver', solvers, ids=ids)
+def test_matsolver_shared_matrix(solver, matsolver):
+    # Build matsolvers from one matrix with data overwritten in place, as for pencil LHS matrices
+    A = solver.pencils[-1].L_exp.copy()
+    A1 = A.copy()
+    try:
+        matsolver1 = matsolver(A, solver)
+        A.data *= 2
+        A2 = A.copy()
+        matsolver2 = matsolver(A, solver)
+    except ModuleNotFoundError:
+        pytest.skip("Matsolver requirements not present.")
+    except ValueError:
+        pytest.xfail("Invalid input for matsolver.")
+    # Check both solutions
+    rng = np.random.default_rng(0)
+    b = rng.standard_normal(A.shape[0]).astype(A.dtype)
+    assert np.allclose(A1 @ matsolver1.solve(b), b)
+    assert np.allclose(A2 @ matsolver2.solve(b), b)
+
+
 # @pytest.mark.parametrize('loops', [1, 10])
 # @pytest.mark.parametrize('matsolver', de.matsolvers.matsolvers.values())
 # @pytest.mark.parametrize('solver', [block_solver(8, 128, np.float64)])
@@ -80,9 +80,10 @@ def apply_matrix(matrix, array, axis, **kw):
 
 def add_sparse(A, B):
     """Add sparse matrices, promoting scalars to multiples of the identity."""
-    A_is_scalar = np.isscalar(A)
-    B_is_scalar = np.isscalar(B)
+    A_is_scalar = not sparse.issparse(A)
+    B_is_scalar = not sparse.issparse(B)
     if A_is_scalar and B_is_scalar:
+        # Scalars or arrays of scalars over modes
         return A + B
     elif A_is_scalar:
         I = sparse.eye(*B.shape, dtype=B.dtype, format=B.format)
@@ -4,8 +4,11 @@ Tools for running in parallel.
 """
 
 import pathlib
+from concurrent.futures import ThreadPoolExecutor
 from mpi4py import MPI
 
+from .cache import CachedFunction
+
 
 class Sync:
     """
@@ -59,3 +62,24 @@ def sync_glob(path, glob, comm=MPI.COMM_WORLD):
         result = comm.bcast(result, root=0)
     return result
 
+
+@CachedFunction
+def thread_pool(workers):
+    """
+    Shared thread pool for offloading work that releases the GIL.
+
+    Parameters
+    ----------
+    workers : int
+        Number of worker threads.
+
+    """
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+def pool_map(workers):
+    """Return map function using a shared thread pool, or the builtin map for serial execution."""
+    if workers > 1:
+        return thread_pool(workers).map
+    else:
+        return map
@@ -1,6 +1,9 @@
 """Tools for equation parsing."""
 
+import ast
 import re
+from functools import reduce
+import numpy as np
 
 from .exceptions import SymbolicParsingError
 
@@ -82,3 +85,73 @@ def lambdify_functions(call, result):
         return call, result
 
 
+class ConditionVectorizer(ast.NodeTransformer):
+    """Rewrite boolean logic in a condition as elementwise array operations."""
+
+    @staticmethod
+    def _call(name, *args):
+        return ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=list(args), keywords=[])
+
+    def _reduce(self, name, args):
+        return reduce(lambda arg0, arg1: self._call(name, arg0, arg1), args)
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.And):
+            return self._reduce('_logical_and', node.values)
+        else:
+            return self._reduce('_logical_or', node.values)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return self._call('_logical_not', node.operand)
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        # Split comparison chains into pairwise comparisons
+        left = node.left
+        comparisons = []
+        for op, right in zip(node.ops, node.comparators):
+            comparisons.append(ast.Compare(left=left, ops=[op], comparators=[right]))
+            left = right
+        return self._reduce('_logical_and', comparisons)
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        return self._call('_where', node.test, node.body, node.orelse)
+
+
+CONDITION_NAMESPACE = {'_logical_and': np.logical_and,
+                       '_logical_or': np.logical_or,
+                       '_logical_not': np.logical_not,
+                       '_where': np.where}
+
+
+def vectorize_condition(condition):
+    """
+    Compile a condition string for evaluation over arrays of indices.
+
+    Boolean operators, comparison chains, and conditional expressions are
+    replaced by their elementwise NumPy equivalents.
+
+    Examples
+    --------
+    >>> code = vectorize_condition('(nx == 0) and not (0 < ny <= 2)')
+    >>> evaluate_condition(code, {'nx': np.array([0, 0, 1]), 'ny': np.array([0, 1, 0])})
+    array([ True, False, False])
+
+    """
+    tree = ast.parse(condition.strip(), mode='eval')
+    tree = ast.fix_missing_locations(ConditionVectorizer().visit(tree))
+    return compile(tree, '<condition>', 'eval')
+
+
+def evaluate_condition(code, index_dict):
+    """Evaluate a vectorized condition over a dictionary of index arrays."""
+    namespace = dict(CONDITION_NAMESPACE)
+    namespace.update(index_dict)
+    return eval(code, namespace)
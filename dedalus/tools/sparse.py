@@ -35,7 +35,9 @@ def scipy_sparse_eigs(A, B, N, target, matsolver, **kw):
     solver = matsolver(C)
     def matvec(x):
         return solver.solve(B.dot(x))
-    D = spla.LinearOperator(dtype=A.dtype, shape=A.shape, matvec=matvec)
+    def matmat(X):
+        return solver.solve_many(B.dot(X))
+    D = spla.LinearOperator(dtype=A.dtype, shape=A.shape, matvec=matvec, matmat=matmat)
     # Solve using scipy sparse algorithm
     evals, evecs = spla.eigs(D, k=N, which='LM', sigma=None, **kw)
     # Rectify eigenvalues
@@ -90,3 +92,162 @@ def fast_csr_matvec(A_csr, x_vec, out_vec):
     _sparsetools.csr_matvec(M, N, A_csr.indptr, A_csr.indices, A_csr.data, x_vec, out_vec)
     return out_vec
 
+
+def csr_block_diag(blocks, dtype=None):
+    """
+    Build a block diagonal CSR matrix from a sequence of CSR blocks, directly
+    joining the CSR arrays rather than passing through a block grid.
+
+    Parameters
+    ----------
+    blocks : sequence of CSR matrices
+        Input matrix blocks.
+    dtype : dtype specifier, optional
+        The data-type of the output matrix.  If not given, the dtype is
+        determined from that of `blocks`.
+
+    Returns
+    -------
+    res : CSR matrix
+    """
+    blocks = [sparse.csr_matrix(block) for block in blocks]
+    # Handle empty sequences, e.g. from processes without local pencils
+    if not blocks:
+        return sparse.csr_matrix((0, 0), dtype=dtype)
+    if dtype is None:
+        dtype = np.result_type(*[block.dtype for block in blocks])
+    # Block offsets
+    shapes = np.array([block.shape for block in blocks], dtype=np.int64)
+    nnzs = np.array([block.nnz for block in blocks], dtype=np.int64)
+    row_offsets = np.concatenate(([0], np.cumsum(shapes[:, 0])))
+    col_offsets = np.concatenate(([0], np.cumsum(shapes[:, 1])))
+    nnz_offsets = np.concatenate(([0], np.cumsum(nnzs)))
+    M, N, nnz = row_offsets[-1], col_offsets[-1], nnz_offsets[-1]
+    # Use 64-bit indices only when necessary
+    if max(M, N, nnz) > np.iinfo(np.int32).max:
+        index_dtype = np.int64
+    else:
+        index_dtype = np.int32
+    # Join CSR arrays
+    data = np.concatenate([block.data for block in blocks]).astype(dtype, copy=False)
+    indices = np.concatenate([block.indices.astype(index_dtype) + index_dtype(col_offsets[i]) for i, block in enumerate(blocks)])
+    indptr = np.concatenate([block.indptr[:-1].astype(index_dtype) + index_dtype(nnz_offsets[i]) for i, block in enumerate(blocks)] + [np.array([nnz], dtype=index_dtype)])
+    return sparse.csr_matrix((data, indices, indptr), shape=(M, N))
+
+
+def scaled_selection(A_csr):
+    """
+    Decompose a CSR matrix with at most one entry per row as a scaled selection
+    of vector entries, such that A @ x = scales * x[cols].
+
+    Parameters
+    ----------
+    A_csr : CSR matrix
+        Input matrix.
+
+    Returns
+    -------
+    scales : 1D array
+        Row scalings (zero for empty rows).
+    cols : 1D int array or None
+        Selected columns, or None if the matrix is diagonal.
+    Returns None if any row has multiple entries.
+    """
+    if A_csr.format != "csr":
+        raise ValueError("Matrix must be in CSR format.")
+    M, N = A_csr.shape
+    row_nnz = np.diff(A_csr.indptr)
+    if np.any(row_nnz > 1):
+        return None
+    # Gather single entries, leaving empty rows with zero scaling
+    rows = np.flatnonzero(row_nnz)
+    scales = np.zeros(M, dtype=A_csr.dtype)
+    cols = np.zeros(M, dtype=A_csr.indices.dtype)
+    scales[rows] = A_csr.data[A_csr.indptr[rows]]
+    cols[rows] = A_csr.indices[A_csr.indptr[rows]]
+    # Drop selection for diagonal matrices
+    if (M == N) and np.all(cols[rows] == rows):
+        cols = None
+    return scales, cols
+
+
+def split_scaled_selection(A_csr, row_offsets):
+    """
+    Split a CSR matrix by groups of rows (e.g. pencils) into a scaled selection
+    over the groups with at most one entry per row, and a CSR remainder over
+    the other groups, such that A @ x = scales * x[cols] + remainder @ x.
+
+    Parameters
+    ----------
+    A_csr : CSR matrix
+        Input matrix.
+    row_offsets : 1D int array
+        Starting rows of the groups, followed by the total number of rows.
+
+    Returns
+    -------
+    selection : tuple or None
+        Scaled selection (scales, cols) as from scaled_selection, with zero
+        scaling on the remainder rows, or None if no group qualifies.
+    remainder : CSR matrix or None
+        Matrix holding the rows of the other groups, or None if all qualify.
+    """
+    if A_csr.format != "csr":
+        raise ValueError("Matrix must be in CSR format.")
+    row_nnz = np.diff(A_csr.indptr)
+    # Flag rows in groups with multiple entries in any row
+    group_sizes = np.diff(row_offsets)
+    group_multiple = np.array([np.any(row_nnz[start:end] > 1) for start, end in zip(row_offsets[:-1], row_offsets[1:])], dtype=bool)
+    remainder_rows = np.repeat(group_multiple, group_sizes)
+    if not np.any(remainder_rows):
+        return scaled_selection(A_csr), None
+    if np.all(remainder_rows):
+        return None, A_csr
+    # Split entries by row
+    def select_rows(rows):
+        entries = np.repeat(rows, row_nnz)
+        indptr = np.concatenate(([0], np.cumsum(row_nnz * rows))).astype(A_csr.indptr.dtype)
+        return sparse.csr_matrix((A_csr.data[entries], A_csr.indices[entries], indptr), shape=A_csr.shape)
+    selection = scaled_selection(select_rows(~remainder_rows))
+    return selection, select_rows(remainder_rows)
+
+
+def bandwidths(A):
+    """Compute the lower and upper bandwidths of a sparse matrix."""
+    A = A.tocoo()
+    if A.nnz == 0:
+        return 0, 0
+    offsets = A.col.astype(int) - A.row.astype(int)
+    return max(0, -int(offsets.min())), max(0, int(offsets.max()))
+
+
+def band_fill(A):
+    """Compute the fraction of nonzero entries within the band of a square sparse matrix."""
+    kl, ku = bandwidths(A)
+    N = A.shape[0]
+    # Number of entries within the band
+    size = N * (kl + ku + 1) - kl * (kl + 1) // 2 - ku * (ku + 1) // 2
+    return A.nnz / max(size, 1)
+
+
+def rcm_permutation(A):
+    """
+    Compute a symmetric reverse Cuthill-McKee permutation reducing the
+    bandwidth of a square sparse matrix.
+
+    Returns
+    -------
+    perm : int array or None
+        Permutation such that A[perm][:, perm] has reduced bandwidth, or
+        None if the reordering does not reduce the bandwidth.
+
+    """
+    from scipy.sparse.csgraph import reverse_cuthill_mckee
+    A = A.tocoo()
+    # Symmetrize pattern
+    pattern = sparse.csr_matrix((np.ones(A.nnz), (A.row, A.col)), shape=A.shape)
+    pattern = (pattern + pattern.T).tocsr()
+    perm = reverse_cuthill_mckee(pattern, symmetric_mode=True).astype(int)
+    if max(bandwidths(pattern[perm][:, perm])) >= max(bandwidths(pattern)):
+        return None
+    return perm
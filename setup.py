@@ -19,6 +19,7 @@ from distutils.util import strtobool
 import numpy as np
 import mpi4py
 import os
+import re
 import sys
 import glob
 
@@ -160,6 +161,14 @@ extensions = [
         libraries=libraries,
         library_dirs=library_dirs,
         runtime_library_dirs=library_dirs,
+        extra_compile_args=extra_compile_args),
+    Extension(
+        name='dedalus.core.combinations',
+        sources=['dedalus/core/combinations.pyx'],
+        include_dirs=include_dirs,
+        libraries=libraries,
+        library_dirs=library_dirs,
+        runtime_library_dirs=library_dirs,
         extra_compile_args=extra_compile_args)]
 
 # Runtime requirements
@@ -178,6 +187,10 @@ install_requires = [
 with open('README.md') as f:
     long_description = f.read()
 
+# Grab version from package, so it is defined in one place
+with open(os.path.join('dedalus', '__init__.py')) as f:
+    version = re.search(r"^__version__ = '(.*)'", f.read(), re.MULTILINE).group(1)
+
 # Cython directives
 compiler_directives = {}
 compiler_directives['language_level'] = 3
@@ -186,7 +199,7 @@ if bool_env('CYTHON_PROFILE', unset=False):
 
 setup(
     name='dedalus',
-    version='2.2006a1',
+    version=version,
     author='Keaton J. Burns',
     author_email='keaton.burns@gmail.com',
     description="A flexible framework for solving PDEs with modern spectral methods.",